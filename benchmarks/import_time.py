@@ -0,0 +1,60 @@
+"""
+Measures how long `import synth` takes in a fresh interpreter, and checks that the slow optional
+dependencies (pygame, librosa, pyrubberband) are not imported with it.
+
+    python benchmarks/import_time.py [--repeat N] [--max-seconds S]
+
+Exits with a non-zero status if a heavy module got imported or if the median import time exceeds `--max-seconds`.
+"""
+from __future__ import annotations
+
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+HEAVY_MODULES = ("pygame", "librosa", "pyrubberband")
+
+SCRIPT = f"""
+import sys, time
+start = time.perf_counter()
+import synth
+print(time.perf_counter() - start)
+print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))
+"""
+
+
+def measure() -> tuple[float, list[str]]:
+    out = subprocess.run([sys.executable, "-c", SCRIPT], cwd=ROOT, capture_output=True, text=True, check=True)
+    seconds, heavy = out.stdout.splitlines()
+    return float(seconds), [m for m in heavy.split(",") if m]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=0.5)
+    args = parser.parse_args()
+
+    times = []
+    heavy = []
+    for _ in range(args.repeat):
+        seconds, heavy = measure()
+        times.append(seconds)
+
+    median = statistics.median(times)
+    print(f"import synth: median {median * 1000:.1f} ms, min {min(times) * 1000:.1f} ms over {args.repeat} runs")
+
+    if heavy:
+        print(f"FAIL: `import synth` also imports {', '.join(heavy)}")
+        return 1
+    if median > args.max_seconds:
+        print(f"FAIL: import time above {args.max_seconds * 1000:.0f} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
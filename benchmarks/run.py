@@ -0,0 +1,311 @@
+"""
+Render benchmark suite: times every stage of the synth, measures its peak memory and writes the results as JSON.
+
+    python benchmarks/run.py [--output FILE] [--baseline FILE] [--threshold R] [--repeat N] [--quick] [-k PATTERN]
+
+Every benchmark is run once to warm up, then `--repeat` times (the median is kept), then once more under tracemalloc
+for its peak memory.
+With `--baseline`, the results are compared with a previous output and the exit status is non-zero if a benchmark got
+more than `--threshold` (a ratio, 0.25 meaning 25%) slower, or used that much more memory.
+`--quick` shortens the workloads, to check that the suite runs rather than to measure anything.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import import_time  # noqa: E402
+from synth import ADSR, Harmonic, Note, Playable, Sample, Score, Song, Timbre, Tone, oscillators as osc  # noqa: E402
+from synth import cache, effects as eff, pitch, playables, samples  # noqa: E402
+from synth.constants import MAX_AMPLITUDE, SAMPLE_RATE  # noqa: E402
+from synth.effects.modulators import LFO  # noqa: E402
+
+# setup of every benchmark, returning the function to time
+Setup = Callable[[], Callable[[], object]]
+
+MELODY = "C4 E4 G4 B4 2*C5 A4 F4 D4 - 2*E4 G4 B4 D5 4*C5 --"
+SAMPLE_FILE = ROOT / "samples" / "middle_c.wav"
+
+
+def timbre(harmonics: int) -> Timbre:
+    oscillators = (osc.sine, osc.sawtooth, osc.square, osc.triangle)
+    return Timbre(
+        amplitude_enveloppe=ADSR(attack=.02, decay=.05, sustain=0.7, release=.1),
+        pitch_enveloppe=ADSR(attack=0.0, decay=0.0, sustain=0.0, release=0.0, level=1),
+        harmonics=[Harmonic(frequency=k + 1, amplitude=1 / (k + 1), oscillator=oscillators[k % 4])
+                   for k in range(harmonics)]
+    )
+
+
+def organ(partials: int) -> Timbre:
+    """Timbre of `partials` sine harmonics, rendered by the additive engine"""
+    return Timbre(
+        amplitude_enveloppe=ADSR(attack=.02, decay=.05, sustain=0.7, release=.1),
+        pitch_enveloppe=ADSR(attack=0.0, decay=0.0, sustain=0.0, release=0.0, level=1),
+        harmonics=[Harmonic(frequency=k + 1, amplitude=1 / (k + 1), oscillator=osc.sine) for k in range(partials)]
+    )
+
+
+def times(seconds: float) -> np.ndarray:
+    return np.linspace(0, seconds, int(seconds * SAMPLE_RATE), endpoint=False)
+
+
+def tone(seconds: float) -> np.ndarray:
+    return (MAX_AMPLITUDE * osc.sawtooth(times(seconds), 220.0)).astype(np.float32)
+
+
+def score(minutes: float, voices: int = 4, bpm: int = 240) -> list[tuple[Timbre, str, list]]:
+    """`voices` lines of a looped melody lasting `minutes`, as given to `Song.from_lines`"""
+    beats = sum(float(n.split('*')[0]) if '*' in n else n.count('-') or 1 for n in MELODY.split())
+    loops = int(np.ceil(minutes * bpm / beats))
+    return [(timbre(4), " ".join([MELODY] * loops), []) for _ in range(voices)]
+
+
+def song(notes: int, polyphony: int, note_length: float = 0.25) -> Song:
+    """`polyphony` voices of back to back notes, `notes` in total"""
+    return Song([Note(Tone(48 + (i * 7) % 24), timbre(4), start=(i // polyphony) * note_length,
+                      length=note_length) for i in range(notes)])
+
+
+def collect(quick: bool) -> dict[str, Setup]:
+    seconds = 1.0 if quick else 10.0
+    minutes = 0.5 if quick else 10.0
+    benchmarks: dict[str, Setup] = {}
+
+    def add(name: str):
+        def register(setup: Setup) -> Setup:
+            benchmarks[name] = setup
+            return setup
+        return register
+
+    add("import synth")(lambda: lambda: import_time.measure())
+
+    for h in (1, 4, 16, 64):
+        @add(f"Note.generate_raw[harmonics={h}]")
+        def _(h=h):
+            note = Note(Tone(57), timbre(h), length=seconds)
+            t = times(note.length)
+            return lambda: note.generate_raw(t)
+
+    for p in (32, 128):
+        @add(f"Note.generate_raw[sine partials={p}]")
+        def _(p=p):
+            note = Note(Tone(45), organ(p), length=seconds)
+            t = times(note.length)
+            return lambda: note.generate_raw(t)
+
+    for name, oscillator in [("sine", osc.sine), ("square", osc.square), ("triangle", osc.triangle),
+                             ("sawtooth", osc.sawtooth), ("Pulse", osc.Pulse(0.25)),
+                             ("Wavetable", osc.Wavetable(osc.sawtooth))]:
+        @add(f"oscillator.{name}[{seconds:g}s]")
+        def _(oscillator=oscillator):
+            t = times(seconds)
+            oscillator(t[:16], 440.0)  # builds the tables of the wavetables
+            return lambda: oscillator(t, 440.0)
+
+    for name, effect in [("Noise", eff.Noise(1e-3)),
+                         ("Noise[lfo]", eff.Noise(LFO(frequency=2.0, amplitude=5e-4, center=1e-3))),
+                         ("Normalize", eff.Normalize()),
+                         ("Transpose[resample]", eff.Transpose(7, method="resample")),
+                         ("Transpose[rubberband]", eff.Transpose(7, method="rubberband")),
+                         ("Transpose[lfo]", eff.Transpose(LFO(frequency=5.0, amplitude=0.5))),
+                         ("Scratch", eff.Scratch(1e-2)),
+                         ("LowPassFilter[fir]", eff.LowPassFilter(880, resonance=0.5, resonance_width=220,
+                                                                  cutout_width=880, mode="fir")),
+                         ("LowPassFilter[iir]", eff.LowPassFilter(880, resonance=0.5, mode="iir")),
+                         ("LowPassFilter[lfo]", eff.LowPassFilter(LFO(frequency=2.0, amplitude=400, center=880)))]:
+        @add(f"{name}.postprocess[{seconds:g}s]")
+        def _(effect=effect):
+            t, sound = times(seconds), tone(seconds)
+            note = Note(Tone(57), timbre(1), length=seconds)
+            # effects working in place get a fresh copy of the input every time (the copy is part of the timing)
+            return lambda: effect.postprocess(t, sound.copy() if effect.in_place else sound, note)
+
+    @add(f"Playable.render_uncached[6 effects,{seconds * 6:g}s]")
+    def _():
+        noise = playables.Noise(seconds * 6, seed=0)
+        noise.effects = [eff.Noise(1e-3), eff.LowPassFilter(2000, mode="iir"), eff.Transpose(3, method="resample"),
+                         eff.Scratch(1e-2), eff.LowPassFilter(LFO(frequency=2.0, amplitude=300, center=1000)),
+                         eff.LowPassFilter(3000, mode="fir")]
+        return lambda: noise.render_uncached()
+
+    for n, p in [(100, 1), (1000, 4), (1000, 16), (10000, 8)]:
+        if quick and n > 1000:
+            continue
+
+        @add(f"Song.generate_raw[notes={n},polyphony={p}]")
+        def _(n=n, p=p):
+            s = song(n, p)
+            t = times(s.length)
+            return lambda: s.generate_raw(t)
+
+    @add(f"Song.from_lines[{minutes:g}min]")
+    def _():
+        lines = score(minutes)
+        return lambda: Song.from_lines(240, lines)
+
+    @add(f"Score.parse[{minutes:g}min]")
+    def _():
+        lines = score(minutes)
+        return lambda: Score.parse(240, lines)
+
+    @add(f"Score.generate_raw[{minutes:g}min]")
+    def _():
+        s = Score.parse(240, score(minutes))
+        t = times(s.length)
+        return lambda: s.generate_raw(t)
+
+    @add(f"Song.generate[{minutes:g}min score]")
+    def _():
+        s = Song.from_lines(240, score(minutes))
+        return lambda: s.generate()
+
+    for workers in (1, 4):
+        @add(f"Song.generate_raw[{minutes:g}min score,workers={workers}]")
+        def _(workers=workers):
+            s = Song.from_lines(240, score(minutes))
+            s.workers = workers
+            t = times(s.length)
+            return lambda: s.generate_raw(t)
+
+    @add(f"Song.generate_raw[{minutes:g}min score,1 note changed]")
+    def _():
+        s = Song.from_lines(240, score(minutes))
+        s.incremental = True
+        t = times(s.length)
+        s.generate_raw(t)
+        note = s.playables[len(s.playables) // 2]
+
+        def edit():
+            note.volume = 1.5 - note.volume
+            return s.generate_raw(t)
+        return edit
+
+    if SAMPLE_FILE.exists():
+        @add("SampleStore.load[decode]")
+        def _():
+            return lambda: samples.SampleStore(tempfile.mkdtemp()).load(SAMPLE_FILE)
+
+        @add("Sample.transposed_many[25 intervals,resample]")
+        def _():
+            s = Sample(SAMPLE_FILE)
+            return lambda: s.transposed_many(range(-12, 13), method="resample")
+
+        @add(f"Song.generate_raw[samples,{seconds:g}s]")
+        def _():
+            keyboard = Sample(SAMPLE_FILE).transposed_many(range(-12, 13), method="resample")
+            hits = []
+            for i in range(int(seconds * 8)):
+                hit = keyboard[(i * 5) % 25 - 12].transposed(0)
+                hit.start = i / 8
+                hits.append(hit)
+            s = Song(hits)
+            t = times(s.length)
+            return lambda: s.generate_raw(t)
+
+    for sample_format in ("int16", "int24", "float32"):
+        @add(f"Playable.save[{sample_format},{seconds * 6:g}s]")
+        def _(sample_format=sample_format):
+            sound = tone(seconds * 6)
+            data = sound.astype(np.int16) if sample_format == "int16" else sound / 32768
+            path = Path(tempfile.mkdtemp()) / "out.wav"
+            return lambda: Playable.save(data, path, sample_format)
+
+    return benchmarks
+
+
+def run(setup: Setup, repeat: int) -> dict[str, float]:
+    fn = setup()
+    fn()  # warm-up: lazy imports, tables, allocator
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"seconds": statistics.median(durations), "min_seconds": min(durations), "peak_bytes": peak}
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> list[str]:
+    """Descriptions of the regressions of `results` compared with `baseline`"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in ("seconds", "peak_bytes"):
+            if base[metric] > 0 and result[metric] > base[metric] * (1 + threshold):
+                regressions.append(f"{name}: {metric} {base[metric]:.4g} -> {result[metric]:.4g} "
+                                   f"(+{result[metric] / base[metric] - 1:.0%})")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", type=Path, default=Path("benchmark.json"))
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("-k", dest="pattern", default="", help="only run the benchmarks whose name contains PATTERN")
+    args = parser.parse_args()
+
+    # everything is rendered for real: no render cache, and transpositions are not kept
+    cache.set_render_cache(None)
+    pitch.set_pitch_shifter(pitch.PitchShifter(max_bytes=0, directory=None))
+    samples.set_sample_store(samples.SampleStore(tempfile.mkdtemp()))
+
+    results = {}
+    for name, setup in collect(args.quick).items():
+        if args.pattern not in name:
+            continue
+        try:
+            results[name] = run(setup, args.repeat)
+        except Exception as e:  # a missing optional dependency (e.g. the rubberband CLI) skips the benchmark
+            print(f"{name:<56} skipped: {type(e).__name__}: {e}")
+            continue
+        seconds, peak = results[name]["seconds"], results[name]["peak_bytes"]
+        print(f"{name:<56} {seconds * 1000:10.1f} ms {peak / 2 ** 20:10.1f} MiB")
+
+    args.output.write_text(json.dumps({
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "quick": args.quick,
+        "results": results,
+    }, indent=2))
+
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get("quick") != args.quick:
+            print("WARNING: the baseline was not run with the same --quick setting")
+        regressions = compare(results, baseline["results"], args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,3 +4,4 @@ from . import oscillators
 from .notes import *
 from .playables import *
 from .song import *
+from .score import *
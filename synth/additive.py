@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from functools import lru_cache
+
+import numpy as np
+
+"""
+Module of the additive engine, rendering banks of sine partials by inverse FFT (the FFT⁻¹ synthesis of Rodet and
+Depalle) instead of evaluating a sine per partial and per sample.
+
+Every `HOP` samples, a frame of the sum of the partials is built in the frequency domain: each partial adds the main
+lobe of the spectrum of a Blackman-Harris window (`2 * LOBE` bins) at its frequency, with its amplitude and phase.
+One inverse FFT per frame gives the windowed sum, the window is divided out of the middle of the frame and replaced by
+a triangle, and the triangles of consecutive frames overlap-add to the output. The cost is one FFT per frame and a few
+bins per partial, whatever the number of partials.
+
+The frequency and phase of every partial are taken at the center of every frame, so the frequency evolves at frame
+rate (fast glides of high partials get a small phase error). Partials within `LOBE` bins of the Nyquist frequency
+are dropped rather than aliased.
+"""
+
+# samples between the centers of two frames
+HOP = 256
+# samples of a frame, the window being divided out of its middle half only, where it is large enough
+FRAME = 4 * HOP
+# bins on each side of a partial, the main lobe of the 4-term Blackman-Harris window (sidelobes are below -92 dB)
+LOBE = 4
+# points per bin of the table of the main lobe, interpolated linearly
+OVERSAMPLING = 256
+# frames built at once, to bound the size of the spectra
+CHUNK_FRAMES = 256
+
+_WINDOW = (0.35875, 0.48829, 0.14128, 0.01168)
+
+
+@lru_cache(maxsize=None)
+def _tables() -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Spectrum of the window at the `2 * LOBE` bins around a partial, by fraction of bin between the bin below the
+    partial and the partial (`OVERSAMPLING` rows), its slope from one row to the next, and the gains turning the
+    middle of a frame into a triangle.
+    """
+    n = np.arange(-FRAME // 2, FRAME // 2)
+    window = sum(a * np.cos(2 * np.pi * k * n / FRAME) for k, a in enumerate(_WINDOW))
+
+    # spectrum of the rectangular window of `n`: e^(iπν/N) sin(πν) / sin(πν/N)
+    def dirichlet(nu: np.ndarray) -> np.ndarray:
+        return np.exp(1j * np.pi * nu / FRAME) * FRAME * np.sinc(nu) / np.sinc(nu / FRAME)
+
+    # the bins are 1 - LOBE to LOBE bins above the bin below the partial
+    nu = np.arange(1 - LOBE, LOBE + 1) - np.linspace(0.0, 1.0, OVERSAMPLING + 1)[:, None]
+    lobe = _WINDOW[0] * dirichlet(nu)
+    for k, a in enumerate(_WINDOW[1:], 1):
+        lobe += a / 2 * (dirichlet(nu - k) + dirichlet(nu + k))
+
+    middle = np.arange(-HOP, HOP)
+    gains = (1 - np.abs(middle) / HOP) / window[middle + FRAME // 2]
+    return lobe[:-1], np.diff(lobe, axis=0), gains
+
+
+def _lobe(nu: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """The bins around partials at `nu` bins, and the spectrum of the window at these bins"""
+    lobe, slopes, _ = _tables()
+    below = np.floor(nu)
+    fraction = (nu - below) * OVERSAMPLING
+    row = fraction.astype(np.intp)
+    values = slopes.take(row, axis=0)
+    values *= (fraction - row)[:, None]
+    values += lobe.take(row, axis=0)
+    return below.astype(np.intp)[:, None] + np.arange(1 - LOBE, LOBE + 1), values
+
+
+def _spectra(phases: np.ndarray, increments: np.ndarray, ratios: np.ndarray, amplitudes: np.ndarray) -> np.ndarray:
+    """Spectra of the windowed frames, `phases` and `increments` being the phase and frequency of the fundamental"""
+    bins = FRAME // 2 + 1
+    # frequency (in bins) and phase (in cycles) of every partial of every frame
+    nu = increments[:, None] * ratios * FRAME
+    phase = np.mod(phases[:, None] * ratios, 1.0)
+    frame, partial = np.nonzero((nu > 0) & (nu < bins - 1 - LOBE))
+    nu = nu[frame, partial]
+    # a sin(2πθ) is a / 2i (e^(2iπθ) - e^(-2iπθ)): a lobe at ν and a conjugate one at -ν
+    coefficients = -0.5j * amplitudes[partial] * np.exp(2j * np.pi * phase[frame, partial])
+    positions, values = _lobe(nu)
+    values *= coefficients[:, None]
+    # the lobes at -ν only reach the first bins, they are the lobes at ν mirrored around 0 (conjugated),
+    # and the bins of the lobes at ν below 0 are left in `LOBE` extra bins in front of every spectrum
+    low = nu < LOBE
+    mirrored = -positions[low]
+    indices = np.concatenate(((frame[:, None] * (bins + LOBE) + LOBE + positions).ravel(),
+                              (frame[low, None] * (bins + LOBE) + LOBE + np.maximum(mirrored, -LOBE)).ravel()))
+    mirrored_values = np.where(mirrored >= 0, np.conj(values[low]), 0.0)
+    values = np.concatenate((values.ravel(), mirrored_values.ravel()))
+
+    size = phases.shape[0] * (bins + LOBE)
+    spectra = np.bincount(indices, values.real, size) + 1j * np.bincount(indices, values.imag, size)
+    return spectra.reshape(phases.shape[0], bins + LOBE)[:, LOBE:]
+
+
+def render_partials(cycles: np.ndarray, ratios: Sequence[float], amplitudes: Sequence[float]) -> np.ndarray:
+    """
+    Sum of `amplitudes[k] * sin(2π * ratios[k] * cycles)` over the partials, `cycles` being the phase of the
+    fundamental of every sample (along the last axis, at least 2 samples).
+    """
+    ratios = np.asarray(ratios, dtype=np.float64)
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    rows = cycles.reshape(-1, cycles.shape[-1])
+    size = rows.shape[1]
+
+    # the phase and frequency of the fundamental at the center of every frame, extrapolated past the last sample
+    blocks = -(-size // HOP)
+    centers = np.arange(blocks + 1) * HOP
+    last = np.minimum(centers, size - 1)
+    increments = np.diff(rows, axis=-1)[:, np.minimum(last, size - 2)]
+    phases = rows[:, last] + increments * (centers - last)
+    # a frame is a linear extrapolation of the phase from its center: when the frequency varies smoothly, the phase
+    # curves away from it by up to `chirp * HOP² / 8` between two centers, half of which is compensated here.
+    # The chirp is the smallest change of frequency on either side of the frame, 0 around jumps of frequency.
+    changes = np.diff(increments, axis=-1, prepend=increments[:, :1], append=increments[:, -1:])
+    before, after = changes[:, :-1], changes[:, 1:]
+    chirps = np.where(before * after > 0, np.sign(after) * np.minimum(np.abs(before), np.abs(after)), 0.0) / HOP
+    phases += chirps * HOP ** 2 / 16
+    phases, increments = phases.ravel(), increments.ravel()
+
+    _, _, gains = _tables()
+    middles = np.empty((phases.shape[0], 2 * HOP))
+    for i in range(0, phases.shape[0], CHUNK_FRAMES):
+        frames = np.fft.irfft(_spectra(phases[i:i + CHUNK_FRAMES], increments[i:i + CHUNK_FRAMES], ratios,
+                                       amplitudes), FRAME)
+        # the frames are centered on their first sample
+        middles[i:i + CHUNK_FRAMES, :HOP] = frames[:, -HOP:]
+        middles[i:i + CHUNK_FRAMES, HOP:] = frames[:, :HOP]
+    middles *= gains
+
+    # every block of output is the end of the triangle of a frame and the start of the triangle of the next one
+    middles = middles.reshape(rows.shape[0], blocks + 1, 2, HOP)
+    sound = middles[:, :-1, 1] + middles[:, 1:, 0]
+    return sound.reshape(rows.shape[0], -1)[:, :size].reshape(cycles.shape)
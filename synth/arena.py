@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import threading
+import weakref
+from typing import Optional
+
+import numpy as np
+
+"""
+Module reusing the large buffers of the renders: effect chains take their working buffers from a `BufferArena`
+and give them back once done, so that the next playable of a song reuses them instead of allocating its own.
+"""
+
+
+def writable(sound: np.ndarray) -> np.ndarray:
+    """`sound` if it can be modified in place as float32, a float32 copy otherwise"""
+    if sound.dtype == np.float32 and sound.flags.writeable:
+        return sound
+    return sound.astype(np.float32)
+
+
+class BufferArena:
+    """
+    Pools of free buffers by dtype and size, sizes being rounded up to a power of two so that buffers of close sizes
+    are shared. At most `max_bytes` of free buffers are kept, the others are left to the garbage collector.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self._free: dict[tuple[int, str], list[np.ndarray]] = {}
+        self._free_bytes = 0
+        # buffers taken and not given back yet, by id
+        self._taken: weakref.WeakValueDictionary[int, np.ndarray] = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _bucket(size: int) -> int:
+        return 1 << max(size - 1, 0).bit_length()
+
+    def take(self, shape: tuple[int, ...], dtype: np.dtype = np.float32) -> np.ndarray:
+        """An uninitialized array of `shape`, to give back with `give` once it is not used anymore"""
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        bucket = self._bucket(size)
+        with self._lock:
+            pool = self._free.get((bucket, dtype.str))
+            if pool:
+                buffer = pool.pop()
+                self._free_bytes -= buffer.nbytes
+                self.hits += 1
+            else:
+                buffer = np.empty(bucket, dtype=dtype)
+                self.misses += 1
+            self._taken[id(buffer)] = buffer
+        return buffer[:size].reshape(shape)
+
+    def copy(self, sound: np.ndarray, dtype: np.dtype = np.float32) -> np.ndarray:
+        """`sound` copied (and converted to `dtype`) into a buffer of the arena"""
+        buffer = self.take(sound.shape, dtype)
+        np.copyto(buffer, sound, casting="unsafe")
+        return buffer
+
+    def owns(self, array: np.ndarray) -> bool:
+        """Whether `array` is (a view of) a buffer taken from the arena and not given back"""
+        return array.base is not None and self._taken.get(id(array.base)) is array.base
+
+    def give(self, array: np.ndarray) -> None:
+        """Gives back a buffer from `take`: neither it nor its views may be used afterwards"""
+        buffer = array.base
+        with self._lock:
+            if buffer is None or self._taken.get(id(buffer)) is not buffer:
+                return
+            del self._taken[id(buffer)]
+            if self._free_bytes + buffer.nbytes <= self.max_bytes:
+                self._free.setdefault((buffer.shape[0], buffer.dtype.str), []).append(buffer)
+                self._free_bytes += buffer.nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._free.clear()
+            self._free_bytes = 0
+
+    @property
+    def free_bytes(self) -> int:
+        return self._free_bytes
+
+
+_arena: Optional[BufferArena] = BufferArena()
+
+
+def set_arena(arena: Optional[BufferArena]) -> None:
+    """Sets the arena of the effect chains, None to allocate every buffer"""
+    global _arena
+    _arena = arena
+
+
+def get_arena() -> Optional[BufferArena]:
+    return _arena
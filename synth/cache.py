@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import enum
+import hashlib
+import os
+import tempfile
+import types
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import numpy as np
+
+"""
+Module caching the output of `Playable.generate`, keyed on a stable hash of the playable's parameters.
+The cache is disabled until one is set with `set_render_cache`.
+"""
+
+
+class Uncacheable(Exception):
+    """Raised when a value has no stable hash (e.g. a lambda)"""
+
+
+def stable_hash(value: Any, memo: Optional[dict[int, str]] = None) -> str:
+    """
+    Hashes a value from its content, so that equal parameters give the same hash across runs.
+    Objects are hashed from their class and public attributes, or from their `cache_state()` if they define one.
+    `memo` maps `id()`s of already hashed objects to their hash, to share the work between several calls.
+    Only pass it while the hashed objects are neither modified nor garbage collected.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    _feed(h, value, {} if memo is None else memo)
+    return h.hexdigest()
+
+
+def _name(value: Any) -> str:
+    name = f"{value.__module__}.{value.__qualname__}"
+    if "<" in name:
+        raise Uncacheable(f"{name} is not importable and cannot be hashed")
+    return name
+
+
+def _feed(h: hashlib.blake2b, value: Any, memo: dict[int, str]) -> None:
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.generic)):
+        h.update(f"{type(value).__name__}:{value!r};".encode())
+    elif isinstance(value, enum.Enum):
+        h.update(f"enum:{_name(type(value))}.{value.name};".encode())
+    elif isinstance(value, (list, tuple)):
+        h.update(f"{type(value).__name__}[{len(value)}]".encode())
+        for v in value:
+            _feed(h, v, memo)
+    elif isinstance(value, dict):
+        h.update(f"dict[{len(value)}]".encode())
+        for k in sorted(value, key=repr):
+            _feed(h, k, memo)
+            _feed(h, value[k], memo)
+    elif isinstance(value, (type, types.FunctionType, types.BuiltinFunctionType)):
+        h.update(f"ref:{_name(value)};".encode())
+    elif isinstance(value, np.ufunc):
+        if getattr(np, value.__name__, None) is not value:
+            raise Uncacheable(f"ufunc {value.__name__} is not a NumPy function and cannot be hashed")
+        h.update(f"ref:numpy.{value.__name__};".encode())
+    else:
+        digest = memo.get(id(value))
+        if digest is None:
+            sub = hashlib.blake2b(digest_size=16)
+            if isinstance(value, np.ndarray):
+                sub.update(f"array:{value.dtype.str}{value.shape}".encode())
+                sub.update(np.ascontiguousarray(value).data)
+            else:
+                sub.update(f"object:{_name(type(value))}".encode())
+                if hasattr(value, "cache_state"):
+                    state = value.cache_state()
+                elif hasattr(value, "__dict__"):
+                    state = {k: v for k, v in vars(value).items() if not k.startswith("_")}
+                else:
+                    # sets, ufuncs, objects with `__slots__`...
+                    raise Uncacheable(f"{type(value).__name__} has no attributes to hash")
+                _feed(sub, state, memo)
+            digest = memo[id(value)] = sub.hexdigest()
+        h.update(digest.encode())
+
+
+class RenderCache:
+    """
+    LRU cache of rendered sounds holding at most `max_bytes` in memory,
+    optionally backed by a directory of `.npy` files that is never evicted.
+    Cached arrays are read-only.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20, directory: Optional[Union[str, Path]] = None):
+        self.max_bytes = max_bytes
+        self.directory = None if directory is None else Path(directory)
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+        self._entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.nbytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        sound = self._entries.get(key)
+        if sound is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return sound
+
+        if self.directory is not None:
+            path = self.directory / f"{key}.npy"
+            if path.exists():
+                self.disk_hits += 1
+                sound = np.load(path)
+                self._store(key, sound)
+                return sound
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, sound: np.ndarray) -> np.ndarray:
+        sound = self._store(key, sound.copy() if sound.flags.writeable else sound)
+        if self.directory is not None:
+            path = self.directory / f"{key}.npy"
+            if not path.exists():
+                # written next to its final place then renamed, so that concurrent processes never read a partial file
+                fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, sound)
+                os.replace(tmp, path)
+        return sound
+
+    def _store(self, key: str, sound: np.ndarray) -> np.ndarray:
+        sound.flags.writeable = False
+        if sound.nbytes > self.max_bytes:
+            return sound
+
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self._entries[key] = sound
+        self.nbytes += sound.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+        return sound
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+_render_cache: Optional[RenderCache] = None
+
+
+def set_render_cache(cache: Optional[RenderCache]) -> None:
+    """Sets the cache used by every `Playable.generate`, or disables caching with `None`"""
+    global _render_cache
+    _render_cache = cache
+
+
+def get_render_cache() -> Optional[RenderCache]:
+    return _render_cache
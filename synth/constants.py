@@ -1,3 +1,10 @@
+import os
+from pathlib import Path
+
 SAMPLE_RATE = 44100
 MAX_AMPLITUDE = 4096
 EPSILON = 1e-6
+BLOCK_SIZE = 1024
+
+# directory of the on-disk caches (decoded samples, ...), can be overridden with the SYNTH_CACHE_DIR variable
+CACHE_DIR = Path(os.environ.get("SYNTH_CACHE_DIR", Path.home() / ".cache" / "synth"))
@@ -1,83 +1,257 @@
 from __future__ import annotations
 
 from abc import ABC
+from collections.abc import Sequence
+from typing import Optional
 
 import numpy as np
-import pyrubberband
 
-from . import modulators
+from . import filters, modulators
+from .. import arena, pitch, rng, telemetry
 from ..constants import MAX_AMPLITUDE, SAMPLE_RATE
 
 
+def per_frame(value: float | np.ndarray, sound: np.ndarray) -> float | np.ndarray:
+    """Lines up a value given per frame (or a constant) with a sound, mono or of shape (frames, channels)"""
+    return value[:, None] if np.ndim(value) == 1 and sound.ndim > 1 else value
+
+
 class Effect(ABC):
+    """
+    Effect applied to the sound of a playable, mono or of shape (frames, channels),
+    `t` being the time of every frame.
+    """
+
+    # whether the effect always gives the same output for the same input, so that its output can be cached
+    cacheable = True
+    # whether `postprocess` writes its output over `sound` (and returns it) when `sound` is a writable float32
+    # array, so that the effect chain of a playable can run in a single buffer
+    in_place = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # every effect is profiled, see `telemetry`
+        for stage in ("preprocess", "postprocess", "process_block"):
+            if stage in vars(cls):
+                setattr(cls, stage, telemetry.profiled(stage)(vars(cls)[stage]))
+
+    @telemetry.profiled("preprocess")
     def preprocess(self, playable: Playable):
         pass
 
+    # delay (in samples) that `process_block` adds to the sound
+    latency = 0
+
+    @telemetry.profiled("postprocess")
     def postprocess(self, t: np.ndarray, sound: np.ndarray, p: Playable) -> np.ndarray:
         return sound
 
+    @telemetry.profiled("process_block")
+    def process_block(self, t: np.ndarray, block: np.ndarray, p: Playable) -> np.ndarray:
+        """
+        Processes one block of a stream, `t` being the times of its samples.
+        Defaults to `postprocess`, which is right for effects working sample by sample.
+        """
+        return self.postprocess(t, block, p)
+
+    def reset(self) -> None:
+        """Forgets the state kept by `process_block` between two blocks, to start a new stream"""
+        pass
+
 
 class Noise(Effect):
-    def __init__(self, volume: float | modulators.EffectModulator):
-        self.volume = volume
+    """
+    Adds uniform noise, drawn from `seed` (see `rng`) so that the same frames always get the same noise.
+    The noise is added in place when the sound is a writable float32 array.
+    """
+
+    in_place = True
+
+    def __init__(self, volume: float | modulators.EffectModulator, seed: int | np.random.Generator | None = None):
+        self.volume = modulators.resolve(volume)
+        self.seed = rng.make_seed(seed)
 
     def postprocess(self, t: np.ndarray, sound: np.ndarray, _p: Playable) -> np.ndarray:
-        return sound + (
-                    np.random.random(sound.shape) * modulators.EffectModulator.handle(self.volume, t) * MAX_AMPLITUDE)
+        volume = modulators.EffectModulator.handle(self.volume, t)
+        return rng.add_uniform(sound, self.seed, rng.first_frame(t), per_frame(volume * MAX_AMPLITUDE, sound))
 
 
 class Normalize(Effect):
+    in_place = True
+
     def postprocess(self, _t: np.ndarray, sound: np.ndarray, p: Playable) -> np.ndarray:
-        return sound * p.volume * MAX_AMPLITUDE / np.max(sound)
+        sound = arena.writable(sound)
+        return np.multiply(sound, p.volume * MAX_AMPLITUDE / np.max(sound), out=sound)
+
+    def process_block(self, t: np.ndarray, block: np.ndarray, p: Playable) -> np.ndarray:
+        raise ValueError("Normalize needs the whole sound and cannot be applied to a stream")
 
 
 class Transpose(Effect):
-    def __init__(self, interval: int | modulators.EffectModulator):
-        self.interval = interval
+    """
+    Shifts the pitch by `interval` semitones, with a method of `pitch.PitchShifter` (its default if None).
+    A modulated interval reads the sound at a varying speed, which is only possible with the "resample" method.
+    """
+
+    def __init__(self, interval: int | modulators.EffectModulator, method: Optional[str] = None):
+        self.interval = modulators.resolve(interval)
+        self.method = method
+        if isinstance(self.interval, modulators.EffectModulator) and method not in (None, "resample"):
+            raise ValueError(f"a modulated interval needs the 'resample' method, not '{method}'")
 
     def postprocess(self, t: np.ndarray, sound: np.ndarray, _p: Playable) -> np.ndarray:
-        if self.interval != 0:
-            return (MAX_AMPLITUDE * pyrubberband.pyrb.pitch_shift(sound.astype(np.float64) / MAX_AMPLITUDE,
-                                                                  sr=SAMPLE_RATE,
-                                                                  n_steps=modulators.EffectModulator.handle(
-                                                                      self.interval, t))).astype(
-                np.int16)
-        else:
+        interval = modulators.EffectModulator.handle(self.interval, t)
+        if np.ndim(interval):
+            return pitch.varispeed_shift(sound, interval)
+        if interval == 0:
             return sound
+        return pitch.get_pitch_shifter().shift(sound, interval, self.method)
+
+    def process_block(self, t: np.ndarray, block: np.ndarray, p: Playable) -> np.ndarray:
+        raise ValueError("Transpose needs the whole sound and cannot be applied to a stream")
+
+
+def fold_transpositions(effects: Sequence[Effect]) -> list[Effect]:
+    """
+    Merges consecutive constant transpositions using the same method into one,
+    dropping them if they cancel out, as every transposition is costly and degrades the sound a bit.
+    """
+    folded: list[Effect] = []
+    for e in effects:
+        previous = folded[-1] if folded else None
+        if (isinstance(e, Transpose) and isinstance(previous, Transpose) and e.method == previous.method
+                and not isinstance(e.interval, modulators.EffectModulator)
+                and not isinstance(previous.interval, modulators.EffectModulator)):
+            folded[-1] = Transpose(previous.interval + e.interval, e.method)
+        else:
+            folded.append(e)
+    return [e for e in folded if not (isinstance(e, Transpose) and e.interval == 0)]
 
 
 class Scratch(Effect):
-    def __init__(self, percentage: float | modulators.EffectModulator = 0.02):
-        self.percentage = percentage
+    """
+    Replaces a `percentage` of the samples by noise. Only the positions of the replaced samples are drawn,
+    from `seed` (see `rng`), and they are written in place when the sound is a writable float32 array.
+    """
 
-    def postprocess(self, t: np.ndarray, sound: np.ndarray, _p: Playable) -> np.ndarray:
-        mask = np.random.random(sound.shape) < modulators.EffectModulator.handle(self.percentage, t)
-        noise = np.random.random(sound.shape) * MAX_AMPLITUDE
+    in_place = True
 
-        return np.where(mask, noise, sound).astype(np.int16)
+    def __init__(self, percentage: float | modulators.EffectModulator = 0.02,
+                 seed: int | np.random.Generator | None = None):
+        self.percentage = modulators.resolve(percentage)
+        self.seed = rng.make_seed(seed)
+
+    def postprocess(self, t: np.ndarray, sound: np.ndarray, _p: Playable) -> np.ndarray:
+        percentage = modulators.EffectModulator.handle(self.percentage, t)
+        return rng.scatter(sound, self.seed, rng.first_frame(t), percentage, MAX_AMPLITUDE)
 
 
 class LowPassFilter(Effect):
+    """
+    Resonant low-pass filter, with two engines:
+    - "fir": the gain rises from 1 to `1 + resonance` over `resonance_width` Hz up to `cutout`, then falls to 0 over
+      `cutout_width` Hz. It is applied with a linear phase FIR kernel, convolved by overlap-add.
+    - "iir": a 2nd order resonant filter, with a gain of `(1 + resonance) / sqrt(2)` at `cutout` (the widths are
+      ignored). Its coefficients are updated every `CONTROL_SIZE` samples, so the parameters can be modulated.
+    The default "auto" mode uses the FIR engine for constant parameters and the IIR one otherwise.
+    Whole sounds are filtered in place when they are writable float32 arrays.
+    """
+
+    in_place = True
+    CONTROL_SIZE = 64
+    # frames filtered at once by the constant IIR engine, to bound the size of its temporaries
+    CHUNK_SIZE = 1 << 16
+    MIN_TAPS = 63
+    MAX_TAPS = 16383
+
     def __init__(self,
                  cutout: float | modulators.EffectModulator,
                  resonance: float | modulators.EffectModulator = 0.0,
                  cutout_width: float | modulators.EffectModulator = 1.0,
-                 resonance_width: float | modulators.EffectModulator = 1.0):
-        self.cutout = cutout
-        self.resonance = resonance
-        self.cutout_width = cutout_width
-        self.resonance_width = resonance_width
+                 resonance_width: float | modulators.EffectModulator = 1.0,
+                 mode: str = "auto"):
+        if mode not in ("auto", "fir", "iir"):
+            raise ValueError(f"unknown mode '{mode}', expected 'auto', 'fir' or 'iir'")
 
-    def postprocess(self, t: np.ndarray, sound: np.ndarray, p: Playable) -> np.ndarray:
-        frequency_space = np.fft.fft(sound)
+        self.cutout = modulators.resolve(cutout)
+        self.resonance = modulators.resolve(resonance)
+        self.cutout_width = modulators.resolve(cutout_width)
+        self.resonance_width = modulators.resolve(resonance_width)
+        self.mode = mode
+
+        # engine of the stream processed by `process_block`
+        self._stream: filters.Biquad | filters.OverlapAdd | None = None
+
+    @property
+    def modulated(self) -> bool:
+        return any(isinstance(v, modulators.EffectModulator)
+                   for v in (self.cutout, self.resonance, self.cutout_width, self.resonance_width))
 
-        filterx = [p.length * (self.cutout - self.resonance_width),
-                   p.length * self.cutout,
-                   p.length * (self.cutout + self.cutout_width)]
-        filtery = [1.0, 1.0 + self.resonance, 0.0]
+    def engine(self) -> str:
+        if self.mode == "auto":
+            return "iir" if self.modulated else "fir"
+        if self.mode == "fir" and self.modulated:
+            raise ValueError("the FIR engine needs constant parameters, use the IIR one to modulate them")
+        return self.mode
+
+    def kernel_size(self) -> int:
+        # the narrowest transition needs the finest frequency resolution
+        width = min(self.cutout_width, self.resonance_width) if self.resonance else self.cutout_width
+        size = int(4 * SAMPLE_RATE / max(width, 1e-3))
+        return min(max(size, self.MIN_TAPS), self.MAX_TAPS) | 1
+
+    def kernel(self) -> np.ndarray:
+        return filters.lowpass_kernel(self.cutout, self.resonance, self.cutout_width, self.resonance_width,
+                                      self.kernel_size())
+
+    @property
+    def latency(self) -> int:
+        return self.kernel_size() // 2 if self.engine() == "fir" else 0
+
+    def _filter_iir(self, biquad: filters.Biquad, t: np.ndarray, sound: np.ndarray,
+                    out: Optional[np.ndarray] = None) -> np.ndarray:
+        out = np.empty(sound.shape, dtype=np.float32) if out is None else out
+        if not self.modulated:
+            b, a = filters.lowpass_coefficients(self.cutout, (1 + self.resonance) * np.sqrt(0.5))
+            for i in range(0, sound.shape[0], self.CHUNK_SIZE):
+                out[i:i + self.CHUNK_SIZE] = biquad.process(sound[i:i + self.CHUNK_SIZE], b, a)
+            return out
+
+        # the coefficients are updated on the multiples of CONTROL_SIZE frames from the start of the sound, so that
+        # blocks of any size get the same updates as a whole render: the frames of a block before its first update
+        # keep the coefficients of the previous block
+        offset = -rng.first_frame(t) % self.CONTROL_SIZE
+        starts = np.arange(offset, sound.shape[0], self.CONTROL_SIZE)
+        if offset and biquad.coefficients is not None:
+            out[:offset] = biquad.process(sound[:offset], *biquad.coefficients)
+        elif offset:
+            starts = np.concatenate(([0], starts))
+        ends = np.append(starts[1:], sound.shape[0])
+
+        # one value per coefficient update, from the control points shared with the other effects of the block
+        def control(value: float | modulators.EffectModulator) -> np.ndarray:
+            if isinstance(value, modulators.EffectModulator):
+                return value.at(t, starts)
+            return np.broadcast_to(value, starts.shape)
+
+        for start, end, cutout, resonance in zip(starts, ends, control(self.cutout), control(self.resonance)):
+            b, a = filters.lowpass_coefficients(cutout, (1 + resonance) * np.sqrt(0.5))
+            out[start:end] = biquad.process(sound[start:end], b, a)
+        return out
+
+    def postprocess(self, t: np.ndarray, sound: np.ndarray, _p: Playable) -> np.ndarray:
+        sound = arena.writable(sound)
+        if self.engine() == "fir":
+            return filters.OverlapAdd(self.kernel()).convolve(sound, out=sound)
+        return self._filter_iir(filters.Biquad(), t, sound, out=sound)
 
-        filter = np.interp(np.arange(0, frequency_space.shape[0]), filterx, filtery)
+    def process_block(self, t: np.ndarray, block: np.ndarray, _p: Playable) -> np.ndarray:
+        if self._stream is None:
+            self._stream = filters.OverlapAdd(self.kernel()) if self.engine() == "fir" else filters.Biquad()
 
-        frequency_space *= filter
+        if isinstance(self._stream, filters.OverlapAdd):
+            return self._stream.process(block).astype(np.float32, copy=False)
+        return self._filter_iir(self._stream, t, block)
 
-        return np.fft.ifft(frequency_space).real.astype(np.int16)
+    def reset(self) -> None:
+        self._stream = None
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+from typing import Optional
+
+import numpy as np
+
+from ..constants import SAMPLE_RATE
+
+"""
+Module containing the stateful filter engines used by the filtering effects.
+They process the sound block by block, carrying their state from one block to the next,
+so that a long sound or a stream gives the same result whatever the block size.
+Sounds are filtered along their first axis, so (frames, channels) sounds are filtered channel by channel.
+"""
+
+
+def lowpass_coefficients(cutoff: float, q: float) -> tuple[np.ndarray, np.ndarray]:
+    """Coefficients (b, a) of a resonant 2nd order low-pass filter (RBJ audio EQ cookbook)"""
+    cutoff = min(max(cutoff, 1.0), 0.49 * SAMPLE_RATE)
+    w0 = 2 * np.pi * cutoff / SAMPLE_RATE
+    alpha = np.sin(w0) / (2 * max(q, 1e-3))
+    cos_w0 = np.cos(w0)
+
+    b = np.array([(1 - cos_w0) / 2, 1 - cos_w0, (1 - cos_w0) / 2])
+    a = np.array([1 + alpha, -2 * cos_w0, 1 - alpha])
+    return b / a[0], a / a[0]
+
+
+class Biquad:
+    """2nd order IIR filter whose coefficients can change between two calls to `process`"""
+
+    def __init__(self):
+        self._state: Optional[np.ndarray] = None
+        # (b, a) of the last call to `process`
+        self.coefficients: Optional[tuple[np.ndarray, np.ndarray]] = None
+
+    def process(self, sound: np.ndarray, b: np.ndarray, a: np.ndarray) -> np.ndarray:
+        from scipy.signal import lfilter
+
+        if self._state is None:
+            self._state = np.zeros((2,) + sound.shape[1:])
+        out, self._state = lfilter(b, a, sound, axis=0, zi=self._state)
+        self.coefficients = (b, a)
+        return out
+
+    def reset(self) -> None:
+        self._state = None
+        self.coefficients = None
+
+
+def lowpass_kernel(cutoff: float, resonance: float, cutoff_width: float, resonance_width: float,
+                   size: int) -> np.ndarray:
+    """
+    Linear phase FIR kernel (of odd `size`) whose response rises linearly from 1 to `1 + resonance`
+    over `resonance_width` Hz up to `cutoff`, then falls to 0 over `cutoff_width` Hz.
+    """
+    frequencies = np.fft.rfftfreq(size, 1 / SAMPLE_RATE)
+    response = np.interp(frequencies,
+                         [cutoff - resonance_width, cutoff, cutoff + cutoff_width],
+                         [1.0, 1.0 + resonance, 0.0])
+    kernel = np.roll(np.fft.irfft(response, size), size // 2)
+    return kernel * np.blackman(size)
+
+
+class OverlapAdd:
+    """FFT convolution of a stream with a (long) FIR kernel, carrying the tail of every block into the next one"""
+
+    def __init__(self, kernel: np.ndarray):
+        self.kernel = kernel
+        self._tail: Optional[np.ndarray] = None
+        self._spectra: dict[int, np.ndarray] = {}
+
+    @property
+    def latency(self) -> int:
+        """Delay of the output, in samples, for a centered (linear phase) kernel"""
+        return self.kernel.shape[0] // 2
+
+    def process(self, sound: np.ndarray) -> np.ndarray:
+        n = sound.shape[0]
+        size = 1 << int(np.ceil(np.log2(n + self.kernel.shape[0] - 1)))
+        spectrum = self._spectra.get(size)
+        if spectrum is None:
+            spectrum = self._spectra[size] = np.fft.rfft(self.kernel, size)
+        if sound.ndim > 1:
+            spectrum = spectrum[:, None]
+        if self._tail is None:
+            self._tail = np.zeros((self.kernel.shape[0] - 1,) + sound.shape[1:])
+
+        full = np.fft.irfft(np.fft.rfft(sound, size, axis=0) * spectrum, size, axis=0)[:n + self.kernel.shape[0] - 1]
+        full[:self._tail.shape[0]] += self._tail
+
+        out = full[:n]
+        self._tail = full[n:]
+        return out
+
+    def reset(self) -> None:
+        self._tail = None
+
+    def convolve(self, sound: np.ndarray, block_size: Optional[int] = None,
+                 out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Filters a whole sound block by block, compensating the latency so that the output lines up with the input.
+        The output is written into `out` if given, which can be `sound` itself: every block is read before the
+        output is written over it.
+        """
+        self.reset()
+        block_size = max(self.kernel.shape[0], 4096) if block_size is None else block_size
+        out = np.empty(sound.shape, dtype=np.float32) if out is None else out
+        total = sound.shape[0] + self.latency
+        for i in range(0, total, block_size):
+            block = sound[i:i + block_size]
+            missing = min(block_size, total - i) - block.shape[0]
+            if missing:
+                block = np.concatenate((block, np.zeros((missing,) + sound.shape[1:], dtype=block.dtype)))
+            filtered = self.process(block)
+
+            # `filtered` starts `latency` frames before frame i of the output
+            first = i - self.latency
+            skipped = max(-first, 0)
+            out[first + skipped:first + filtered.shape[0]] = filtered[skipped:]
+        return out
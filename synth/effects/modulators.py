@@ -1,44 +1,150 @@
 from __future__ import annotations
 
+import contextlib
+import threading
 from abc import ABC, abstractmethod
-from typing import Any
+from collections.abc import Iterator
+from typing import Any, Optional
 
 import numpy as np
 
 from .. import oscillators
+from ..constants import SAMPLE_RATE
+
+"""
+Module of the modulators, the time-varying parameters of the effects.
+Modulators are evaluated at control rate (every `control_size` frames, linearly interpolated in between), and within
+an `evaluation` every modulator is evaluated once per block, however many effects (or other modulators) use it.
+Modulators that cannot vary (e.g. an LFO without amplitude) are resolved to their constant with `resolve`,
+so that effects can pick their constant code path.
+"""
+
+# frames between two evaluations of a modulator, see `EffectModulator.control_size`
+CONTROL_SIZE = 32
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def evaluation(t: np.ndarray) -> Iterator[None]:
+    """Shares the values of the modulators evaluated on `t` (or on slices of it) between the effects of a block"""
+    previous = getattr(_local, "values", None)
+    _local.values = {}
+    try:
+        yield
+    finally:
+        _local.values = previous
 
 
 class EffectModulator(ABC):
+    # frames between two evaluations of `get_value` by `values`, 1 evaluating every frame
+    control_size = CONTROL_SIZE
+
     @abstractmethod
     def get_value(self, t: np.ndarray) -> np.ndarray:
+        """Exact value at every time of `t`"""
         pass
 
+    def constant(self) -> Optional[float]:
+        """The value of the modulator if it never changes, None otherwise"""
+        return None
+
+    def _control(self, t: np.ndarray) -> tuple[Optional[np.ndarray], np.ndarray]:
+        """(frames, values) of the control points of `t`, frames being None when every frame is evaluated"""
+        shared = getattr(_local, "values", None)
+        key = (id(self), id(t), t.shape[0], float(t[0]) if t.shape[0] else 0.0)
+        if shared is not None and key in shared:
+            return shared[key][1]
+
+        size = t.shape[0]
+        if self.control_size <= 1 or size <= 2 * self.control_size:
+            control = (None, np.broadcast_to(self.get_value(t), t.shape))
+        else:
+            # the last frame is always evaluated, so that nothing is extrapolated and stateful modulators end
+            # on the last frame of the block
+            frames = np.append(np.arange(0, size - 1, self.control_size), size - 1)
+            control = (frames, np.broadcast_to(self.get_value(t[frames]), frames.shape))
+        if shared is not None:
+            # `t` is kept so that its id cannot be reused during the evaluation
+            shared[key] = (t, control)
+        return control
+
+    def values(self, t: np.ndarray, step: int = 1) -> np.ndarray:
+        """
+        Value at every `step`-th time of `t`, interpolated between control points.
+        Within an `evaluation`, the control points are shared by every caller using the same `t`.
+        """
+        return self.at(t, np.arange(0, t.shape[0], step))
+
+    def at(self, t: np.ndarray, frames: np.ndarray) -> np.ndarray:
+        """Value at the given `frames` of `t`, interpolated between control points like `values`"""
+        control_frames, control = self._control(t)
+        if control_frames is None:
+            return control[frames]
+        return np.interp(frames, control_frames, control)
+
     @classmethod
-    def handle(cls, value: EffectModulator | Any, t: np.ndarray) -> np.ndarray | Any:
+    def handle(cls, value: EffectModulator | Any, t: np.ndarray, step: int = 1) -> np.ndarray | Any:
         if isinstance(value, cls):
-            return value.get_value(t)
+            return value.values(t, step)
         else:
             return value
 
+    @staticmethod
+    def exact(value: EffectModulator | Any, t: np.ndarray) -> np.ndarray | Any:
+        """`handle` evaluating every time of `t`, for modulators modulating other ones at their own control rate"""
+        return value.get_value(t) if isinstance(value, EffectModulator) else value
+
+
+def resolve(value: EffectModulator | Any) -> EffectModulator | Any:
+    """The constant of a modulator that never changes, `value` itself otherwise"""
+    if isinstance(value, EffectModulator):
+        constant = value.constant()
+        return value if constant is None else constant
+    return value
+
 
 class LFO(EffectModulator):
-    def __init__(self, frequency: float, amplitude: float, center: float = 0.0,
+    def __init__(self, frequency: float | EffectModulator, amplitude: float, center: float = 0.0,
                  oscillator: oscillators.Oscillator = oscillators.sine):
         self.oscillator = oscillator
         self.center = center
         self.amplitude = amplitude
-        self.frequency = frequency
+        self.frequency = resolve(frequency)
+
+        # time and phase of the frame following the last evaluated block, to continue the phase in the next one
+        self._next: tuple[float, float | np.ndarray] | None = None
+
+    def constant(self) -> Optional[float]:
+        return self.center if self.amplitude == 0 else None
 
     def get_value(self, t: np.ndarray) -> np.ndarray:
-        return self.amplitude * self.oscillator(t, self.frequency) + self.center
+        frequency = EffectModulator.exact(self.frequency, t)
+        if self._next is not None and np.isclose(t[0], self._next[0]):
+            phase = self._next[1]
+        else:
+            phase = t[0] * (frequency[0] if np.ndim(frequency) else frequency)
+
+        cycles, _ = oscillators.integrate_phase(t, frequency, phase)
+        # blocks follow each other frame by frame, even when evaluated at control rate
+        end = cycles[-1] + (frequency[-1] if np.ndim(frequency) else frequency) / SAMPLE_RATE
+        self._next = (t[-1] + 1 / SAMPLE_RATE, np.fmod(end, oscillators.PHASE_PERIOD))
+
+        return self.amplitude * oscillators.oscillate(self.oscillator, t, frequency, cycles) + self.center
 
 
 class LinearTransition(EffectModulator):
+    # already a linear interpolation, evaluated exactly
+    control_size = 1
+
     def __init__(self, start_time: float, start_value: float, end_time: float, end_value: float):
         self.start_time = start_time
         self.start_value = start_value
         self.end_time = end_time
         self.end_value = end_value
 
+    def constant(self) -> Optional[float]:
+        return self.start_value if self.start_value == self.end_value else None
+
     def get_value(self, t: np.ndarray) -> np.ndarray:
         return np.interp(t, (self.start_time, self.end_time), (self.start_value, self.end_value))
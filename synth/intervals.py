@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import bisect
+from collections.abc import Callable, Iterable, Iterator
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class IntervalIndex(Generic[T]):
+    """
+    Items sorted by start time, along with the running maximum of their end times,
+    to find the items overlapping a time range without going through all of them.
+    """
+
+    def __init__(self, items: Iterable[T] = (), start: Callable[[T], float] = lambda x: x.start,
+                 end: Callable[[T], float] = lambda x: x.end):
+        self._start = start
+        self._end = end
+
+        self.items: list[T] = sorted(items, key=start)
+        self._starts = [start(x) for x in self.items]
+        self._ends = [end(x) for x in self.items]
+        self._max_ends: list[float] = []
+        self._update_max_ends(0)
+
+    def _update_max_ends(self, i: int) -> None:
+        del self._max_ends[i:]
+        running = self._max_ends[-1] if self._max_ends else float("-inf")
+        for e in self._ends[i:]:
+            running = max(running, e)
+            self._max_ends.append(running)
+
+    def add(self, item: T) -> None:
+        start = self._start(item)
+        i = bisect.bisect_right(self._starts, start)
+        self.items.insert(i, item)
+        self._starts.insert(i, start)
+        self._ends.insert(i, self._end(item))
+        self._update_max_ends(i)
+
+    def remove(self, item: T) -> None:
+        i = self.position(item)
+        del self.items[i], self._starts[i], self._ends[i]
+        self._update_max_ends(i)
+
+    def position(self, item: T) -> int:
+        """Index of `item` in `items`"""
+        start = self._start(item)
+        for i in range(bisect.bisect_left(self._starts, start), len(self.items)):
+            if self.items[i] is item:
+                return i
+        raise ValueError(f"{item!r} is not in the index")
+
+    def refresh(self) -> bool:
+        """
+        Sorts the items again if the start or end time of some of them changed since they were indexed (items moved
+        in place), returning whether they did.
+        """
+        starts = [self._start(x) for x in self.items]
+        ends = [self._end(x) for x in self.items]
+        if starts == self._starts and ends == self._ends:
+            return False
+
+        order = sorted(range(len(self.items)), key=starts.__getitem__)
+        self.items = [self.items[i] for i in order]
+        self._starts = [starts[i] for i in order]
+        self._ends = [ends[i] for i in order]
+        self._update_max_ends(0)
+        return True
+
+    def first_from(self, time: float) -> int:
+        """Index in `items` of the first item starting at or after `time`"""
+        return bisect.bisect_left(self._starts, time)
+
+    def overlapping(self, start: float, end: float) -> list[T]:
+        """Items playing at some point between `start` and `end`, sorted by start time"""
+        hi = bisect.bisect_left(self._starts, end)
+        lo = bisect.bisect_right(self._max_ends, start, 0, hi)
+        return [self.items[i] for i in range(lo, hi) if self._ends[i] > start]
+
+    @property
+    def end(self) -> float:
+        return self._max_ends[-1] if self._max_ends else 0.0
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
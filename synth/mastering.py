@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from typing import Optional
+
+import numpy as np
+
+"""
+Module containing the output stage, the only place where the float32 mix bus is quantized to int16.
+"""
+
+INT16_MAX = np.iinfo(np.int16).max
+
+
+def sliding_min(a: np.ndarray, width: int) -> np.ndarray:
+    """Minimum of every window of `width` consecutive values (van Herk/Gil-Werman, in O(n))"""
+    n = a.shape[0]
+    if n < width:
+        return np.empty(0, dtype=a.dtype)
+
+    blocks = np.concatenate((a, np.full(-n % width, np.inf, dtype=a.dtype))).reshape(-1, width)
+    prefix = np.minimum.accumulate(blocks, axis=1).ravel()
+    suffix = np.minimum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    return np.minimum(suffix[:n - width + 1], prefix[width - 1:n])
+
+
+def inter_sample_peaks(sound: np.ndarray) -> np.ndarray:
+    """Estimates the peak between every sample and the next one with a Catmull-Rom spline, cheaper than oversampling"""
+    x = np.pad(sound, [(1, 2)] + [(0, 0)] * (sound.ndim - 1), mode="edge")
+    y0, y1, y2, y3 = x[:-3], x[1:-2], x[2:-1], x[3:]
+    middle = (-y0 + 9 * y1 + 9 * y2 - y3) / 16
+    return np.maximum(np.abs(sound), np.abs(middle))
+
+
+class Limiter:
+    """
+    Look-ahead peak limiter keeping the sound below `ceiling`.
+    The gain is the minimum required gain over the look-ahead window, smoothed by a moving average of the same length,
+    which never lets a peak through. Blocks are processed in a stream, the output lagging `lookahead - 1` samples
+    behind the input until `flush` is called.
+    Multichannel sounds, of shape (frames, channels), get the same gain on every channel.
+    """
+
+    def __init__(self, ceiling: float = INT16_MAX - 2, lookahead: int = 64, true_peak: bool = False):
+        self.ceiling = ceiling
+        self.lookahead = lookahead
+        self.true_peak = true_peak
+
+        self._gains = np.ones(lookahead - 1, dtype=np.float32)
+        self._sound: Optional[np.ndarray] = None
+
+    def process(self, sound: np.ndarray) -> np.ndarray:
+        if self._sound is None:
+            self._sound = np.zeros((0,) + sound.shape[1:], dtype=np.float32)
+
+        peaks = inter_sample_peaks(sound) if self.true_peak else np.abs(sound)
+        if peaks.ndim > 1:
+            peaks = peaks.max(axis=1)
+        required = np.minimum(1.0, self.ceiling / np.maximum(peaks, 1e-9)).astype(np.float32)
+
+        gains = np.concatenate((self._gains, required))
+        sound = np.concatenate((self._sound, sound))
+        count = max(gains.shape[0] - 2 * self.lookahead + 2, 0)
+
+        minimum = sliding_min(gains, self.lookahead)
+        summed = np.concatenate(([0.0], np.cumsum(minimum, dtype=np.float64)))
+        gain = (summed[self.lookahead:] - summed[:-self.lookahead]) / self.lookahead
+
+        self._gains = gains[count:]
+        self._sound = sound[count:]
+        gain = gain[:count].astype(np.float32)
+        return sound[:count] * (gain if sound.ndim == 1 else gain[:, None])
+
+    def flush(self) -> np.ndarray:
+        shape = () if self._sound is None else self._sound.shape[1:]
+        return self.process(np.zeros((self.lookahead - 1,) + shape, dtype=np.float32))
+
+
+class OutputStage:
+    """Limits the float32 mix, adds TPDF dither and rounds it to int16"""
+
+    def __init__(self, limiter: Optional[Limiter] = None, dither: bool = True, seed: int = 0):
+        self.limiter = Limiter() if limiter is None else limiter
+        self.dither = dither
+        self._rng = np.random.default_rng(seed)
+
+    def process(self, sound: np.ndarray) -> np.ndarray:
+        return self._quantize(self.limiter.process(sound))
+
+    def flush(self) -> np.ndarray:
+        return self._quantize(self.limiter.flush())
+
+    def _quantize(self, sound: np.ndarray) -> np.ndarray:
+        if self.dither:
+            # difference of two uniform variables: triangular noise of +-1 LSB
+            noise = self._rng.random(sound.shape + (2,), dtype=np.float32)
+            sound = sound + (noise[..., 0] - noise[..., 1])
+        return np.round(sound).clip(-INT16_MAX - 1, INT16_MAX).astype(np.int16)
+
+    def __call__(self, sound: np.ndarray) -> np.ndarray:
+        return np.concatenate((self.process(sound), self.flush()))
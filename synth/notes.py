@@ -1,12 +1,15 @@
 from __future__ import annotations
 
-from collections.abc import Iterable
+from collections.abc import Iterable, Sequence
 from dataclasses import dataclass
 from typing import Optional
 
 import numpy as np
 
-from .constants import EPSILON
+from . import additive, telemetry
+from .cache import RenderCache
+from .constants import EPSILON, SAMPLE_RATE
+from .oscillators import PHASE_PERIOD, Wavetable, integrate_phase, oscillate, sine
 from .playables import Playable, Oscillator
 
 
@@ -43,6 +46,10 @@ class Tone:
         return 12 * (octave + 1) + Tone.TONES_ID[tone.lower()] + sharp - flat
 
 
+# envelopes rendered by `ADSR.render`
+_envelopes = RenderCache(64 * 2 ** 20)
+
+
 class ADSR:
     """
     Modified version of the ADSR class from torchsynth
@@ -57,20 +64,51 @@ class ADSR:
         self.release = release + EPSILON
         self.level = level
 
-    def get(self, t: np.ndarray, duration: float | np.ndarray) -> np.ndarray:
-        # Calculations to accommodate attack/decay phase cut by note duration.
-        new_attack = np.minimum(self.attack, duration)
-        new_decay = np.clip(duration - self.attack, 0.0, self.decay)
-
-        attack_signal = ADSR.ramp(t, new_attack)
-
-        a = 1.0 - self.sustain
-        b = self.ramp(t, new_decay, start=new_attack, inverse=True)
-        decay_signal = a * b + self.sustain
-
-        release_signal = self.ramp(t, self.release, start=duration, inverse=True)
-
-        return attack_signal * decay_signal * release_signal * self.level
+    def segments(self, duration: float) -> tuple[float, float, float, float]:
+        """
+        Ends of the attack and decay (cut if the note is shorter than them), start of the release and
+        the level the release starts from, for a note held for `duration` seconds.
+        """
+        attack = min(self.attack, duration)
+        decay = min(max(duration - self.attack, 0.0), self.decay)
+        return attack, attack + decay, duration, self.sustain if decay > 0 else 1.0
+
+    def get(self, t: np.ndarray, duration: float | np.ndarray, step: Optional[float | np.ndarray] = None) -> np.ndarray:
+        """
+        Envelope at the (increasing) times `t`, which can be any block of the note.
+        Only the attack, decay and release are computed, the sustain is filled with its constant level.
+        If `t` is `np.arange(size) * step`, the envelope is cached with `render`.
+        `t` can be 2-D (voices x samples), in which case `duration` (and `step`) are (voices x 1) arrays.
+        """
+        if t.ndim > 1:
+            durations = np.broadcast_to(duration, (t.shape[0], 1))[:, 0]
+            if step is not None:
+                steps = np.broadcast_to(step, (t.shape[0], 1))[:, 0]
+                return np.stack([self.render(t.shape[1], s, d) for s, d in zip(steps, durations)])
+            return np.stack([self.get(row, d) for row, d in zip(t, durations)])
+        if step is not None:
+            return self.render(t.shape[0], float(step), float(duration))
+
+        attack_end, decay_end, release_start, release_level = self.segments(float(duration))
+        a, d, s, r = np.searchsorted(t, [attack_end, decay_end, release_start, release_start + self.release])
+
+        envelope = np.empty(t.shape)
+        envelope[:a] = np.clip(t[:a] / attack_end, 0.0, 1.0)
+        envelope[a:d] = 1.0 - (1.0 - self.sustain) * (t[a:d] - attack_end) / (decay_end - attack_end)
+        envelope[d:s] = self.sustain
+        envelope[s:r] = release_level * (1.0 - (t[s:r] - release_start) / self.release)
+        envelope[r:] = 0.0
+        if self.level != 1.0:
+            envelope *= self.level
+        return envelope
+
+    def render(self, size: int, step: float, duration: float) -> np.ndarray:
+        """Envelope at the times `np.arange(size) * step`, cached as notes of the same length come up again and again"""
+        key = repr((self.attack, self.decay, self.sustain, self.release, self.level, duration, size, step))
+        envelope = _envelopes.get(key)
+        if envelope is None:
+            envelope = _envelopes.put(key, self.get(np.arange(size) * step, duration))
+        return envelope
 
     def __mul__(self, other: float) -> ADSR:
         return self.__class__(
@@ -101,14 +139,86 @@ class Harmonic:
     oscillator: Oscillator
 
 
+class HarmonicSum:
+    """Oscillator summing harmonics, used to bake a whole timbre into a single `Wavetable`"""
+
+    def __init__(self, harmonics: Iterable[Harmonic]):
+        self.harmonics = tuple(harmonics)
+
+    def __call__(self, t: Optional[np.ndarray], frequency: float | np.ndarray = 1.0,
+                 phase: Optional[np.ndarray] = None) -> np.ndarray:
+        cycles = t * frequency if phase is None else phase
+        return sum(h.amplitude * oscillate(h.oscillator, None, h.frequency * frequency, h.frequency * cycles)
+                   for h in self.harmonics)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, HarmonicSum) and self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+    def _key(self) -> tuple:
+        return tuple((h.frequency, h.amplitude, h.oscillator) for h in self.harmonics)
+
+
 @dataclass
 class Timbre:
     pitch_enveloppe: ADSR
     amplitude_enveloppe: ADSR
     harmonics: Iterable[Harmonic]
 
+    # sine harmonics from which they are rendered together by the additive engine, see `additive`
+    ADDITIVE_PARTIALS = 16
+
+    def render(self, t: np.ndarray, frequency: float | np.ndarray, duration: float | np.ndarray,
+               step: Optional[float | np.ndarray] = None) -> np.ndarray:
+        """
+        Renders the timbre at the given base frequency for a note held for `duration` seconds.
+        `t` can be 2-D (voices x samples), in which case `frequency` and `duration` are (voices x 1) arrays.
+        `step` tells that `t` is `np.arange(samples) * step`, so that the envelopes can be cached.
+        From `ADDITIVE_PARTIALS` sine harmonics, they are rendered by inverse FFT with `additive.render_partials`,
+        their frequency following the pitch envelope at frame rate.
+        """
+        frequency = frequency * Tone.to_rel_frequency(self.pitch_enveloppe.get(t, duration, step))
+        # the pitch varies over time, so the phase has to be integrated rather than computed as `t * frequency`
+        cycles, _ = integrate_phase(t, frequency)
+
+        harmonics = list(self.harmonics)
+        sines = [h for h in harmonics if h.oscillator is sine]
+        if len(sines) >= self.ADDITIVE_PARTIALS and t.shape[-1] > additive.HOP:
+            sound = additive.render_partials(cycles, [h.frequency for h in sines], [h.amplitude for h in sines])
+            harmonics = [h for h in harmonics if h.oscillator is not sine]
+        else:
+            sound = np.zeros(t.shape)
+        for h in harmonics:
+            sound += h.amplitude * oscillate(h.oscillator, t, h.frequency * frequency, h.frequency * cycles)
+
+        sound *= self.amplitude_enveloppe.get(t, duration, step)
+
+        return sound
+
+    def with_wavetable(self, interpolation: str = "linear") -> Timbre:
+        """
+        Returns the same timbre with all its harmonics baked into a single band-limited `Wavetable`,
+        so that rendering costs one table lookup per sample whatever the number of harmonics.
+        Only works if every harmonic repeats within the table (integer or half-integer frequencies).
+        """
+        if any((h.frequency * PHASE_PERIOD) % 1 for h in self.harmonics):
+            raise ValueError("only harmonics with integer or half-integer frequencies can be baked into a wavetable")
+
+        return Timbre(
+            pitch_enveloppe=self.pitch_enveloppe,
+            amplitude_enveloppe=self.amplitude_enveloppe,
+            harmonics=[Harmonic(frequency=1.0, amplitude=1.0,
+                                oscillator=Wavetable(HarmonicSum(self.harmonics), interpolation))]
+        )
+
 
 class Note(Playable):
+    # maximum number of samples (voices x longest voice) rendered at once by `render_batch`,
+    # past that the temporaries fall out of the CPU caches and batching gets slower than rendering one by one
+    BATCH_SAMPLES = 1 << 14
+
     def __init__(self, tone: Tone, timbre: Timbre, start: float = 0.0, length: float = 1.0, volume: float = 1.0,
                  effects=None):
         self.tone = tone
@@ -122,17 +232,65 @@ class Note(Playable):
         self.volume = volume
 
     def generate_raw(self, t) -> (np.ndarray, np.ndarray):
-        # terrible, unoptimized code
-        # if a numpy nerd can fix this I'd be grateful
-        # (at least it works?)
-        sound = np.zeros(t.shape)
-        for h in self.timbre.harmonics:
-            sound += h.amplitude * h.oscillator(t,
-                                                h.frequency
-                                                * self.tone.frequency
-                                                * Tone
-                                                .to_rel_frequency(self.timbre.pitch_enveloppe.get(t, self.raw_length)))
-
-        sound *= self.timbre.amplitude_enveloppe.get(t, self.raw_length)
+        return self.timbre.render(t, self.tone.frequency, self.raw_length)
 
-        return sound
+    def render_uncached(self) -> np.ndarray:
+        # a batch of one note, so that the envelopes are cached
+        return self.render_batch([self])[0]
+
+    @classmethod
+    @telemetry.profiled("render_batch")
+    def render_batch(cls, notes: Sequence[Note]) -> list[np.ndarray]:
+        """
+        Renders notes sharing the same timbre together, as a (voices x samples) array per batch.
+        Returns the same thing as calling `render` on every note.
+        """
+        if not notes:
+            return []
+        timbre = notes[0].timbre
+        if any(n.timbre is not timbre for n in notes):
+            raise ValueError("all notes of a batch must share the same timbre")
+
+        for n in notes:
+            for e in n.effects:
+                e.preprocess(n)
+
+        sizes = np.array([round(n.length * SAMPLE_RATE) for n in notes])
+        # voices of similar sizes are batched together to limit padding
+        order = np.argsort(sizes, kind="stable")
+        results: list[np.ndarray] = [None] * len(notes)
+        i = 0
+        while i < len(notes):
+            j = i + 1
+            while j < len(notes) and (j + 1 - i) * sizes[order[j]] <= cls.BATCH_SAMPLES:
+                j += 1
+            batch, i = order[i:j], j
+            voices = [notes[k] for k in batch]
+
+            if telemetry.profiler is None:
+                sounds = cls._render_voices(timbre, voices)
+            else:
+                # one span per batch, most notes of a song being rendered in batches
+                sounds = telemetry.profiler.call("voices", cls, cls._render_voices, timbre, voices,
+                                                 details={"notes": len(voices), "tones": [n.tone.id for n in voices]})
+            for k, sound in zip(batch, sounds):
+                results[k] = sound
+
+        return results
+
+    @staticmethod
+    def _render_voices(timbre: Timbre, voices: Sequence[Note]) -> list[np.ndarray]:
+        """Renders a batch of notes as a single (voices x samples) array, and finalizes every voice"""
+        sizes = np.array([round(n.length * SAMPLE_RATE) for n in voices])
+        lengths = np.array([n.length for n in voices])
+        # same spacing as `np.linspace(0, length, size)` for every voice
+        steps = lengths / np.maximum(sizes - 1, 1)
+        t = np.arange(sizes.max()) * steps[:, None]
+
+        sound = timbre.render(
+            t,
+            Tone.id_to_freqency(np.array([n.tone.id for n in voices]))[:, None],
+            np.array([n.raw_length for n in voices])[:, None],
+            steps[:, None]
+        )
+        return [n.finalize(t[row, :size], sound[row, :size]) for row, (n, size) in enumerate(zip(voices, sizes))]
@@ -1,31 +1,139 @@
 from __future__ import annotations
 
+import inspect
+import weakref
 from collections.abc import Callable
-from typing import Union
+from typing import Optional, Protocol
 
 import numpy as np
 
+from .constants import SAMPLE_RATE
+
 """
 Module containing various types of oscillators.
+
+Oscillators compute their phase as `t * frequency`, which is only correct for a constant frequency.
+When the frequency varies over time, the phase (in cycles) can instead be integrated with `integrate_phase`
+or `PhaseAccumulator` and passed with the `phase` keyword, in which case `t` is ignored.
+Oscillators written for the older `(t, frequency)` convention, without `phase`, still work when called through
+`oscillate`.
 """
 
-Oscillator = Callable[[np.ndarray, Union[float, np.ndarray]], np.ndarray]
+
+class Oscillator(Protocol):
+    def __call__(self, t: Optional[np.ndarray], frequency: float | np.ndarray = 1.0,
+                 phase: Optional[np.ndarray] = None) -> np.ndarray:
+        ...
+
+
+# whether an oscillator takes the `phase` keyword, see `accepts_phase`
+_accepts_phase: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def accepts_phase(oscillator: Callable) -> bool:
+    """Whether `oscillator` takes the `phase` keyword, its signature being inspected once"""
+    try:
+        return _accepts_phase[oscillator]
+    except (KeyError, TypeError):
+        pass
+
+    try:
+        parameters = inspect.signature(oscillator).parameters.values()
+    except (TypeError, ValueError):
+        accepts = False
+    else:
+        accepts = any(p.name == "phase" or p.kind is p.VAR_KEYWORD for p in parameters)
+    try:
+        _accepts_phase[oscillator] = accepts
+    except TypeError:
+        # neither hashable nor weakly referenceable, inspected again next time
+        pass
+    return accepts
+
+
+def oscillate(oscillator: Callable, t: Optional[np.ndarray], frequency: float | np.ndarray = 1.0,
+              phase: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Calls `oscillator` like an `Oscillator`, passing `phase` only if it accepts it.
+    Otherwise it is called as `oscillator(t, frequency)`, or with the phase as `t` and a frequency of 1 if `t` is None.
+    """
+    if phase is None:
+        return oscillator(t, frequency)
+    if accepts_phase(oscillator):
+        return oscillator(t, frequency, phase=phase)
+    return oscillator(phase, 1.0) if t is None else oscillator(t, frequency)
+
+
+# every built-in waveform repeats after 2 cycles (the pulse and square waves have a 2-cycle period),
+# so accumulated phases can be wrapped around this value without changing the output
+PHASE_PERIOD = 2.0
+
+
+def _accumulate(increments: np.ndarray, phase: float | np.ndarray) -> tuple[np.ndarray, float | np.ndarray]:
+    cycles = np.cumsum(increments, axis=-1)
+    end = phase + cycles[..., -1]
+    cycles -= increments
+    cycles += np.asarray(phase)[..., None] if np.ndim(phase) else phase
+    return cycles, end
+
+
+def integrate_phase(t: np.ndarray, frequency: float | np.ndarray = 1.0,
+                    phase: float | np.ndarray = 0.0) -> tuple[np.ndarray, float | np.ndarray]:
+    """
+    Integrates `frequency` over the times `t` (along the last axis) into a phase in cycles, starting at `phase`.
+    Returns the phase of every sample and the phase of the sample following the last one.
+    """
+    if t.shape[-1] > 1:
+        dt = np.diff(t, axis=-1)
+        dt = np.concatenate((dt, dt[..., -1:]), axis=-1)
+    else:
+        dt = np.full(t.shape, 1 / SAMPLE_RATE)
+
+    return _accumulate(np.broadcast_to(frequency * dt, t.shape), phase)
+
+
+class PhaseAccumulator:
+    """Integrates the frequency of an oscillator block by block, carrying the phase from one block to the next"""
+
+    def __init__(self, phase: float = 0.0, sample_rate: int = SAMPLE_RATE):
+        self.phase = phase
+        self.sample_rate = sample_rate
+
+    def advance(self, frequency: float | np.ndarray, size: Optional[int] = None) -> np.ndarray:
+        size = np.shape(frequency)[-1] if size is None else size
+        increments = np.broadcast_to(np.asarray(frequency, dtype=np.float64) / self.sample_rate, (size,))
+        cycles, end = _accumulate(increments, self.phase)
+        self.phase = np.fmod(end, PHASE_PERIOD)
+
+        return cycles
+
+    def reset(self, phase: float = 0.0) -> None:
+        self.phase = phase
+
+
+def _cycles(t: Optional[np.ndarray], frequency: float | np.ndarray, phase: Optional[np.ndarray]) -> np.ndarray:
+    return t * frequency if phase is None else phase
 
 
-def sine(t: np.ndarray, frequency: float | np.ndarray = 1.0) -> np.ndarray:
-    return np.sin(t * 2 * np.pi * frequency)
+def sine(t: Optional[np.ndarray], frequency: float | np.ndarray = 1.0,
+         phase: Optional[np.ndarray] = None) -> np.ndarray:
+    return np.sin(_cycles(t, frequency, phase) * 2 * np.pi)
 
 
-def square(t: np.ndarray, frequency: float | np.ndarray = 1.0) -> np.ndarray:
-    return (-1) ** (t * frequency).astype(int)
+def square(t: Optional[np.ndarray], frequency: float | np.ndarray = 1.0,
+           phase: Optional[np.ndarray] = None) -> np.ndarray:
+    return (-1) ** _cycles(t, frequency, phase).astype(int)
 
 
-def triangle(t: np.ndarray, frequency: float | np.ndarray = 1.0) -> np.ndarray:
-    return 2 * np.absolute(t * frequency - np.floor(t * frequency + 0.5))
+def triangle(t: Optional[np.ndarray], frequency: float | np.ndarray = 1.0,
+             phase: Optional[np.ndarray] = None) -> np.ndarray:
+    cycles = _cycles(t, frequency, phase)
+    return 2 * np.absolute(cycles - np.floor(cycles + 0.5))
 
 
-def sawtooth(t: np.ndarray, frequency: float | np.ndarray = 1.0) -> np.ndarray:
-    return (frequency * t) % 1
+def sawtooth(t: Optional[np.ndarray], frequency: float | np.ndarray = 1.0,
+             phase: Optional[np.ndarray] = None) -> np.ndarray:
+    return _cycles(t, frequency, phase) % 1
 
 
 class Pulse:
@@ -34,5 +142,100 @@ class Pulse:
     def __init__(self, width: float):
         self.width = width
 
-    def __call__(self, t: np.ndarray, frequency: float | np.ndarray = 1.0) -> np.ndarray:
-        return 2 * (((t * frequency / 2) % 1) < self.width) - 1
+    def __call__(self, t: Optional[np.ndarray], frequency: float | np.ndarray = 1.0,
+                 phase: Optional[np.ndarray] = None) -> np.ndarray:
+        return 2 * ((_cycles(t, frequency, phase) / 2 % 1) < self.width) - 1
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Pulse) and other.width == self.width
+
+    def __hash__(self) -> int:
+        return hash((Pulse, self.width))
+
+
+# band-limited tables of every waveform used by a `Wavetable`, built once per oscillator
+_WAVETABLES: dict[Oscillator, np.ndarray] = {}
+
+
+class Wavetable:
+    """
+    Band-limited version of another oscillator, reading precomputed tables instead of computing every sample.
+    There is one table per octave of the played frequency, each one keeping only the harmonics below the Nyquist
+    frequency. A table spans `PHASE_PERIOD` cycles, so every built-in waveform fits in it.
+    """
+
+    SIZE = 4096
+    # highest frequency played with the first (richest) table, every next table covers an octave above
+    BASE_FREQUENCY = 20.0
+    OVERSAMPLING = 16
+
+    def __init__(self, oscillator: Oscillator = sawtooth, interpolation: str = "linear"):
+        if interpolation not in ("linear", "cubic"):
+            raise ValueError(f"unknown interpolation '{interpolation}', expected 'linear' or 'cubic'")
+
+        self.oscillator = oscillator
+        self.interpolation = interpolation
+        self.tables = self.get_tables(oscillator)
+
+    def cache_state(self) -> tuple:
+        # the tables only depend on the oscillator, no need to hash them
+        return self.oscillator, self.interpolation
+
+    @classmethod
+    def get_tables(cls, oscillator: Oscillator) -> np.ndarray:
+        tables = _WAVETABLES.get(oscillator)
+        if tables is not None:
+            return tables
+
+        n = cls.SIZE * cls.OVERSAMPLING
+        spectrum = np.fft.rfft(oscillate(oscillator, None, phase=np.arange(n) / n * PHASE_PERIOD))[:cls.SIZE // 2 + 1]
+        spectrum *= cls.SIZE / n
+
+        levels = int(np.ceil(np.log2(SAMPLE_RATE / 2 / cls.BASE_FREQUENCY))) + 1
+        tables = np.empty((levels, cls.SIZE + 3))
+        for k in range(levels):
+            # harmonic h of the table is played at h * frequency / PHASE_PERIOD
+            max_harmonic = int(SAMPLE_RATE / 2 * PHASE_PERIOD / (cls.BASE_FREQUENCY * 2 ** k))
+            level_spectrum = spectrum.copy()
+            level_spectrum[min(max_harmonic, cls.SIZE // 2 - 1) + 1:] = 0.0
+            table = np.fft.irfft(level_spectrum, cls.SIZE)
+            # padding for the interpolation, so that no index has to wrap around
+            tables[k] = np.concatenate((table[-1:], table, table[:2]))
+
+        _WAVETABLES[oscillator] = tables
+        return tables
+
+    def levels(self, frequency: float | np.ndarray) -> int | np.ndarray:
+        # a single table is used for a whole row of samples, the one of its highest frequency
+        highest = np.max(np.abs(frequency), axis=-1) if np.ndim(frequency) else abs(frequency)
+        level = np.ceil(np.log2(np.maximum(highest, self.BASE_FREQUENCY) / self.BASE_FREQUENCY))
+        return np.clip(level, 0, self.tables.shape[0] - 1).astype(int)
+
+    def __call__(self, t: Optional[np.ndarray], frequency: float | np.ndarray = 1.0,
+                 phase: Optional[np.ndarray] = None) -> np.ndarray:
+        position = np.mod(_cycles(t, frequency, phase), PHASE_PERIOD) * (self.SIZE / PHASE_PERIOD)
+        index = position.astype(np.intp)
+        fraction = position - index
+        index += 1
+
+        level = self.levels(frequency)
+        table = self.tables[level]
+        if np.ndim(level):
+            table = table.reshape(level.shape + (1,) * (index.ndim - level.ndim - 1) + table.shape[-1:])
+
+            def read(offset: int) -> np.ndarray:
+                return np.take_along_axis(table, index + offset, axis=-1)
+        else:
+            def read(offset: int) -> np.ndarray:
+                return table[index + offset]
+
+        y1, y2 = read(0), read(1)
+        if self.interpolation == "linear":
+            return y1 + fraction * (y2 - y1)
+
+        # Catmull-Rom spline through the 4 surrounding table values
+        y0, y3 = read(-1), read(2)
+        c1 = 0.5 * (y2 - y0)
+        c2 = y0 - 2.5 * y1 + 2 * y2 - 0.5 * y3
+        c3 = 0.5 * (y3 - y0) + 1.5 * (y1 - y2)
+        return ((c3 * fraction + c2) * fraction + c1) * fraction + y1
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from .cache import RenderCache, stable_hash
+from .constants import SAMPLE_RATE
+
+"""
+Module transposing sounds, with a cache of the results.
+Two methods are available:
+- "rubberband" keeps the duration and the formants, but runs the rubberband CLI for every shift
+- "resample" reads the sound faster or slower like a classic sampler, in process. The duration changes with the pitch,
+  so the result is padded with silence or cut to keep the length of the original sound.
+"""
+
+METHODS = ("rubberband", "resample")
+
+
+def fit(sound: np.ndarray, size: int) -> np.ndarray:
+    """Cuts or pads `sound` with silence to `size` samples"""
+    if sound.shape[0] >= size:
+        return sound[:size]
+    return np.concatenate((sound, np.zeros((size - sound.shape[0],) + sound.shape[1:], dtype=sound.dtype)))
+
+
+# output frames interpolated at once by the "resample" method, to bound the size of its temporaries
+CHUNK_FRAMES = 1 << 16
+
+
+def _interpolate(sound: np.ndarray, positions: np.ndarray, out: np.ndarray) -> None:
+    """Writes into `out` the linear interpolation of `sound` at the (fractional, increasing) frame `positions`"""
+    index = np.minimum(positions.astype(np.int64), sound.shape[0] - 1)
+    following = np.minimum(index + 1, sound.shape[0] - 1)
+    fraction = positions - index
+    if sound.ndim > 1:
+        fraction = fraction[:, None]
+    out[...] = sound[index] + (sound[following] - sound[index]) * fraction
+
+
+def resample_shift(sound: np.ndarray, interval: float) -> np.ndarray:
+    ratio = 2 ** (interval / 12)
+    # frames read before reaching the last one, the rest of the output is silence
+    frames = min(int(np.ceil((sound.shape[0] - 1) / ratio)), sound.shape[0]) if sound.shape[0] > 1 else 0
+    shifted = np.zeros(sound.shape, dtype=np.float32)
+    for i in range(0, frames, CHUNK_FRAMES):
+        stop = min(i + CHUNK_FRAMES, frames)
+        _interpolate(sound, np.arange(i, stop) * ratio, shifted[i:stop])
+    return shifted
+
+
+def varispeed_shift(sound: np.ndarray, intervals: np.ndarray) -> np.ndarray:
+    """`resample_shift` with one interval per frame: the sound is read at a speed varying from frame to frame"""
+    intervals = np.broadcast_to(intervals, sound.shape[:1])
+    shifted = np.zeros(sound.shape, dtype=np.float32)
+    position = 0.0
+    for i in range(0, sound.shape[0], CHUNK_FRAMES):
+        ratios = 2 ** (np.asarray(intervals[i:i + CHUNK_FRAMES], dtype=np.float64) / 12)
+        positions = np.cumsum(ratios)
+        positions -= ratios
+        positions += position
+        position = positions[-1] + ratios[-1]
+
+        frames = np.searchsorted(positions, sound.shape[0] - 1, side="right")
+        _interpolate(sound, positions[:frames], shifted[i:i + frames])
+        if frames < positions.shape[0]:
+            break
+    return shifted
+
+
+def rubberband_shift(sound: np.ndarray, interval: float) -> np.ndarray:
+    import pyrubberband
+
+    # rubberband goes through 16 bits wav files, the sound has to fit in [-1, 1]
+    scale = max(float(np.max(np.abs(sound))), 1e-9) if sound.shape[0] else 1.0
+    shifted = pyrubberband.pyrb.pitch_shift(sound / scale, sr=SAMPLE_RATE, n_steps=interval)
+    return np.multiply(shifted, scale, dtype=np.float32)
+
+
+class PitchShifter:
+    """
+    Transposes sounds by a number of semitones, caching the results on their content, interval and method
+    in an LRU, and on disk if `directory` is given (e.g. `CACHE_DIR / "pitch"`), where nothing is ever evicted.
+    Cached results are read-only.
+    """
+
+    def __init__(self, method: str = "rubberband", max_bytes: int = 128 * 2 ** 20,
+                 directory: Optional[Union[str, Path]] = None, workers: int = 8):
+        self._check(method)
+        self.method = method
+        self.cache = RenderCache(max_bytes, directory)
+        # number of rubberband processes run at once by `shift_many`
+        self.workers = workers
+
+    @staticmethod
+    def _check(method: str) -> None:
+        if method not in METHODS:
+            raise ValueError(f"unknown method '{method}', expected one of {', '.join(METHODS)}")
+
+    def _key(self, content: str, interval: float, method: str) -> str:
+        return stable_hash(("pitch", content, float(interval), method))
+
+    def shift(self, sound: np.ndarray, interval: float, method: Optional[str] = None,
+              content: Optional[str] = None) -> np.ndarray:
+        """
+        Transposes `sound` by `interval` semitones.
+        `content` identifies the sound instead of hashing it, when the caller already knows where it comes from.
+        """
+        return self.shift_many(sound, [interval], method, content)[interval]
+
+    def shift_many(self, sound: np.ndarray, intervals: Iterable[float], method: Optional[str] = None,
+                   content: Optional[str] = None) -> dict[float, np.ndarray]:
+        """Transposes `sound` by every interval at once, running the missing rubberband shifts in parallel"""
+        method = self.method if method is None else method
+        self._check(method)
+        content = stable_hash(sound) if content is None else content
+
+        results: dict[float, np.ndarray] = {}
+        missing = []
+        for interval in intervals:
+            if interval == 0:
+                results[interval] = sound
+                continue
+            shifted = self.cache.get(self._key(content, interval, method))
+            if shifted is None:
+                missing.append(interval)
+            else:
+                results[interval] = shifted
+
+        if missing:
+            if method == "resample":
+                shifted = [resample_shift(sound, i) for i in missing]
+            else:
+                with ThreadPoolExecutor(min(self.workers, len(missing))) as pool:
+                    shifted = list(pool.map(lambda i: rubberband_shift(sound, i), missing))
+            for interval, s in zip(missing, shifted):
+                results[interval] = self.cache.put(self._key(content, interval, method), s)
+
+        return results
+
+
+_pitch_shifter: Optional[PitchShifter] = None
+
+
+def set_pitch_shifter(shifter: PitchShifter) -> None:
+    global _pitch_shifter
+    _pitch_shifter = shifter
+
+
+def get_pitch_shifter() -> PitchShifter:
+    global _pitch_shifter
+    if _pitch_shifter is None:
+        _pitch_shifter = PitchShifter()
+    return _pitch_shifter
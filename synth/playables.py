@@ -2,24 +2,35 @@ from __future__ import annotations
 
 import copy
 import pathlib
-import struct
-import wave
 from abc import ABC, abstractmethod
-from collections.abc import Sequence
+from collections.abc import AsyncIterator, Iterable, Iterator, Sequence
 from pathlib import Path
-from typing import Union
+from types import ModuleType
+from typing import TYPE_CHECKING, Optional, Union
 
 import numpy as np
-import pygame
-import pyrubberband as pyrubberband
-from librosa import load as rosaload
 
-from .constants import MAX_AMPLITUDE, SAMPLE_RATE
-from .effects import Effect
+from . import arena, cache, mastering, pitch, player, rng, samples, telemetry, wavfile
+from .constants import BLOCK_SIZE, MAX_AMPLITUDE, SAMPLE_RATE
+from .effects import Effect, fold_transpositions, modulators
 from .oscillators import Oscillator, sine
 
-pygame.mixer.pre_init(SAMPLE_RATE, -16, 1, allowedchanges=0)
-pygame.init()
+if TYPE_CHECKING:
+    import pygame
+
+
+# pygame, librosa and pyrubberband are slow to import, so they are only imported once they are needed
+def init_mixer(channels: int = 1) -> ModuleType:
+    import pygame
+
+    init = pygame.mixer.get_init()
+    if init and init[2] != channels:
+        pygame.mixer.quit()
+        init = None
+    if not init:
+        pygame.mixer.pre_init(SAMPLE_RATE, -16, channels, allowedchanges=0)
+        pygame.init()
+    return pygame
 
 
 class Playable(ABC):
@@ -32,38 +43,131 @@ class Playable(ABC):
     def end(self):
         return self.start + self.length
 
+    # whether `render` always gives the same output for the same parameters, so that it can be cached
+    cacheable = True
+
+    # placement of the playable in the song it is mixed into, applied while mixing so they are not part of the render:
+    # `pan` goes from -1 (left) to 1 (right) in stereo songs, or gives the gain of every channel of the song
+    pan: float | Sequence[float] = 0.0
+    mix_gain: float = 1.0
+
+    def channel_gains(self, channels: int) -> Optional[np.ndarray]:
+        """Gain of every channel when mixed into a song of `channels` channels, None if they are all 1"""
+        if not isinstance(self.pan, (int, float)):
+            if len(self.pan) != channels:
+                raise ValueError(f"pan gives {len(self.pan)} gains for a song of {channels} channels")
+            return np.asarray(self.pan, dtype=np.float32) * self.mix_gain
+        if self.pan == 0 and self.mix_gain == 1:
+            return None
+
+        gains = np.full(channels, self.mix_gain, dtype=np.float32)
+        if channels == 2:
+            # balance: the opposite side fades out, the center keeps both sides at full level
+            gains *= [min(1.0, 1.0 - self.pan), min(1.0, 1.0 + self.pan)]
+        return gains
+
     @abstractmethod
     def generate_raw(self, t) -> np.ndarray:
         pass
 
-    def generate(self):
+    def cache_key(self, memo: Optional[dict[int, str]] = None) -> Optional[str]:
+        """Stable hash of everything the output of `render` depends on, or `None` if it cannot be cached"""
+        if not self.cacheable or not all(e.cacheable for e in self.effects):
+            return None
+
+        try:
+            return cache.stable_hash((type(self), self.cache_state()), memo)
+        except cache.Uncacheable:
+            return None
+
+    def cache_state(self) -> dict:
+        return {k: v for k, v in vars(self).items() if k not in ("start", "pan", "mix_gain") and not k.startswith("_")}
+
+    @telemetry.profiled("generate")
+    def generate(self) -> np.ndarray:
+        """Renders the playable and quantizes it to int16, the only conversion out of the float32 mix bus"""
+        return mastering.OutputStage()(self.render())
+
+    @telemetry.profiled("render")
+    def render(self) -> np.ndarray:
+        """Renders the playable as float32 samples, normalized to `volume * MAX_AMPLITUDE`"""
+        render_cache = cache.get_render_cache()
+        key = None if render_cache is None else self.cache_key()
+        if key is not None:
+            sound = render_cache.get(key)
+            if sound is not None:
+                return sound
+
+        sound = self.render_uncached()
+        if key is not None:
+            sound = render_cache.put(key, sound)
+        return sound
+
+    def render_uncached(self) -> np.ndarray:
         for e in self.effects:
             e.preprocess(self)
 
         t = np.linspace(0, self.length, round((self.length * SAMPLE_RATE)))
-        sound = self.generate_raw(t)
-        for e in self.effects:
-            sound = e.postprocess(t, sound, self)
-
-        return (sound * self.volume * MAX_AMPLITUDE / np.max(sound)).astype(np.int16)
+        return self.finalize(t, self.generate_raw(t))
+
+    def finalize(self, t: np.ndarray, sound: np.ndarray) -> np.ndarray:
+        """
+        Applies the effects to the output of `generate_raw`, which is never modified, and normalizes the result.
+        Effects working in place run in a single float32 buffer, copied from the arena (or allocated if there is
+        none) before the first of them, and given back once the chain is done: at most two buffers are alive at a time.
+        """
+        buffers = arena.get_arena()
+        # whether `sound` is a buffer of the chain, that effects can write over
+        owned = False
+        with modulators.evaluation(t):
+            for e in fold_transpositions(self.effects):
+                if e.in_place and not owned:
+                    sound = np.array(sound, dtype=np.float32) if buffers is None else buffers.copy(sound)
+                    owned = True
+                result = e.postprocess(t, sound, self)
+                if result is not sound:
+                    if owned and buffers is not None and not np.may_share_memory(result, sound):
+                        buffers.give(sound)
+                    owned = False
+                sound = result
+
+        peak = np.max(sound)
+        factor = self.volume * MAX_AMPLITUDE / peak if peak > 0 else self.volume
+        # the output outlives the chain, it gets its own exact size array
+        out = np.multiply(sound, factor, dtype=np.float32)
+        if owned and buffers is not None:
+            buffers.give(sound)
+        return out
+
+    def render_blocks(self, block_size: int = BLOCK_SIZE, start: float = 0.0) -> Iterator[np.ndarray]:
+        """Float32 blocks of the render, from `start` seconds"""
+        sound = self.render()
+        for i in range(round(start * SAMPLE_RATE), sound.shape[0], block_size):
+            yield sound[i:i + block_size]
+
+    async def render_async(self, block_size: int = BLOCK_SIZE, start: float = 0.0,
+                           depth: int = 8) -> AsyncIterator[np.ndarray]:
+        """`render_blocks` run in a background thread, up to `depth` blocks ahead: `async for block in ...`"""
+        async for block in player.iterate_async(self.render_blocks(block_size, start), depth):
+            yield block
+
+    def generate_blocks(self, block_size: int = BLOCK_SIZE) -> Iterator[np.ndarray]:
+        samples = self.generate()
+        for i in range(0, samples.shape[0], block_size):
+            yield samples[i:i + block_size]
 
     @staticmethod
     def play(samples: np.ndarray, *, wait: bool = True) -> pygame.mixer.Channel:
+        pygame = init_mixer(1 if samples.ndim == 1 else samples.shape[1])
         sound = pygame.sndarray.make_sound(samples)
-        channel = sound.play(-1)
-        if wait:
-            pygame.time.wait(int(samples.shape[0] / SAMPLE_RATE * 1000))
-            pygame.mixer.stop()
+        channel = sound.play()
+        while wait and channel.get_busy():
+            pygame.time.wait(10)
         return channel
 
     @staticmethod
-    def save(samples: np.ndarray, path: Union[str, pathlib.Path]):
-        with wave.open(path, mode='w') as f:
-            f.setnchannels(1)  # mono
-            f.setsampwidth(2)
-            f.setframerate(SAMPLE_RATE)
-            for i in samples:
-                f.writeframesraw(struct.pack('<h', i))
+    def save(samples: np.ndarray, path: Union[str, pathlib.Path], sample_format: str = "int16"):
+        wavfile.write(path, samples, sample_format)
 
     def generate_and_play(self, *, wait: bool = True, debug: bool = False) -> pygame.mixer.Channel:
         if debug:
@@ -76,45 +180,124 @@ class Playable(ABC):
             print("Finished playing!")
         return channel
 
-    def generate_and_save(self, path: Union[str, pathlib.Path]):
-        samples = self.generate()
-        self.save(samples, path)
+    @staticmethod
+    def master_blocks(blocks: Iterable[np.ndarray], sample_format: str = "int16") -> Iterator[np.ndarray]:
+        """
+        Samples of a stream of float32 blocks ready to be saved in `sample_format`.
+        The limiter delays the output a bit, so the blocks do not have the same sizes as the input ones.
+        """
+        if sample_format == "int16":
+            stage = mastering.OutputStage()
+            process, flush = stage.process, stage.flush
+        else:
+            # higher resolution formats skip the int16 quantization, only the limiter is applied
+            limiter = mastering.Limiter()
+
+            def process(block: np.ndarray) -> np.ndarray:
+                return limiter.process(block) / (mastering.INT16_MAX + 1)
+
+            def flush() -> np.ndarray:
+                return limiter.flush() / (mastering.INT16_MAX + 1)
+
+        for block in blocks:
+            samples = process(block)
+            if samples.shape[0]:
+                yield samples
+        # only once every block went through the limiter
+        yield flush()
+
+    @classmethod
+    def master(cls, sound: np.ndarray, sample_format: str = "int16") -> np.ndarray:
+        """Samples of a render ready to be saved in `sample_format`"""
+        return np.concatenate(list(cls.master_blocks([sound], sample_format)))
+
+    def generate_and_save(self, path: Union[str, pathlib.Path], sample_format: str = "int16"):
+        self.save(self.master(self.render(), sample_format), path, sample_format)
 
 
 class Noise(Playable):
-    def __init__(self, length: float, start: float = 0.0, volume: float = 1.0):
+    """White noise drawn from `seed` (see `rng`): the same noise every time it is rendered, in one go or in blocks"""
+
+    def __init__(self, length: float, start: float = 0.0, volume: float = 1.0,
+                 seed: Union[int, np.random.Generator, None] = None):
         self.start = start
         self.length = length
         self.volume = volume
+        self.effects = []
+        self.seed = rng.make_seed(seed)
 
     def generate_raw(self, t: np.ndarray) -> np.ndarray:
-        return np.random.random(t.shape) * self.volume * MAX_AMPLITUDE
+        return rng.add_uniform(np.zeros(t.shape[0], dtype=np.float32), self.seed, rng.first_frame(t),
+                               self.volume * MAX_AMPLITUDE)
 
 
 class Sample(Playable):
     def __init__(self, file_path: Union[Path, str], offset: float = 0.0, start: float = 0.0, length: float = None,
-                 volume: float = 1.0, effects: Sequence[Effect] = None):
-        self.data, _ = rosaload(file_path, sr=SAMPLE_RATE, mono=True, offset=offset, duration=length)
+                 volume: float = 1.0, effects: Sequence[Effect] = None, mono: bool = True):
+        # whether the file is downmixed to mono, otherwise `data` is (frames, channels)
+        self.mono = mono
+        # decoded samples are read-only and shared between all the samples loading the same file
+        self.data = samples.get_sample_store().load(file_path, offset=offset, duration=length, mono=mono)
+        # where `data` comes from, hashed by `cache_key` instead of the data itself: the key of the file in the store,
+        # the interval it is transposed by and the transposition method. Assigning `data` sets it to None, so it is
+        # always set after `data`
+        self.source = (samples.SampleStore.key(file_path, offset, length, mono), 0, None)
 
         self.start = start
         self.length = self.data.shape[0] / SAMPLE_RATE if length is None else length
         self.volume = volume
         self.effects = [] if effects is None else effects
 
-        self.data = self.data / np.max(self.data) * MAX_AMPLITUDE * self.volume
+        self.gain = MAX_AMPLITUDE * self.volume / np.max(self.data)
 
-    def generate_raw(self, t: np.ndarray) -> np.ndarray:
-        return self.data
+    @property
+    def data(self) -> np.ndarray:
+        return self._data
+
+    @data.setter
+    def data(self, data: np.ndarray) -> None:
+        self._data = data
+        # the new data does not come from `source` anymore, it is hashed instead
+        self.source = None
 
-    def transpose(self, interval: int):
-        if interval != 0:
-            self.data = (MAX_AMPLITUDE * pyrubberband.pyrb.pitch_shift(self.data.astype(np.float64) / MAX_AMPLITUDE,
-                                                                       sr=SAMPLE_RATE, n_steps=interval)).astype(
-                np.int16)
+    def cache_state(self) -> dict:
+        state = super().cache_state()
+        if self.source is None:
+            state["data"] = self._data
+        return state
 
-    def transposed(self, interval: int):
-        new = copy.deepcopy(self)
-        new.transpose(interval)
+    def generate_raw(self, t: np.ndarray) -> np.ndarray:
+        return self.data * self.gain
+
+    def transpose(self, interval: int, method: Optional[str] = None):
+        self.data, self.source = self._transpositions([interval], method)[interval]
+
+    def _transpositions(self, intervals: Sequence[int], method: Optional[str]) -> dict[int, tuple]:
+        """(data, source) of the sample transposed by every interval"""
+        if self.source is None:
+            shifted = pitch.get_pitch_shifter().shift_many(self.data, intervals, method)
+            return {i: (shifted[i], None) for i in intervals}
+
+        # transpositions are always made from the file data, so that they do not add up
+        key, current, current_method = self.source
+        shifter = pitch.get_pitch_shifter()
+        method = (current_method or shifter.method) if method is None else method
+        totals = {i: current + i for i in intervals}
+        shifted = shifter.shift_many(samples.get_sample_store().load(key[0], key[3], key[4], self.mono),
+                                     set(totals.values()), method, cache.stable_hash(key))
+        return {i: (shifted[total], (key, total, method if total else None)) for i, total in totals.items()}
+
+    def transposed(self, interval: int, method: Optional[str] = None):
+        return self.transposed_many([interval], method)[interval]
+
+    def transposed_many(self, intervals: Sequence[int], method: Optional[str] = None) -> dict[int, Sample]:
+        """Copies of the sample transposed by every interval, shifted all at once (e.g. to build a keyboard)"""
+        new = {}
+        for interval, (data, source) in self._transpositions(intervals, method).items():
+            # the data is not copied, transpositions replace it instead of modifying it
+            new[interval] = copy.copy(self)
+            new[interval].effects = list(self.effects)
+            new[interval].data, new[interval].source = data, source
         return new
 
     def __add__(self, other):
@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+import asyncio
+import queue
+import threading
+from collections.abc import AsyncIterator, Iterator
+from typing import TYPE_CHECKING, Optional, Union
+
+import numpy as np
+
+from . import mastering
+from .constants import BLOCK_SIZE, SAMPLE_RATE
+
+if TYPE_CHECKING:
+    import pygame
+
+    from .playables import Playable
+
+"""
+Module rendering in the background: blocks are rendered by a thread while they are consumed (played, saved, sent...),
+so that rendering block N + 1 overlaps with the use of block N.
+"""
+
+# marks the end of the blocks in the queue of a `BackgroundRenderer`
+_END = object()
+
+
+class BackgroundRenderer:
+    """
+    Pulls `blocks` in a background thread into a queue of at most `depth` blocks, the thread waiting while it is full.
+    An exception raised while rendering is raised again by `get`.
+    """
+
+    def __init__(self, blocks: Iterator[np.ndarray], depth: int = 8):
+        self._blocks = blocks
+        self._queue: queue.Queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self.rendered = 0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        try:
+            for block in self._blocks:
+                if not self._put(block):
+                    return
+                self.rendered += 1
+        except BaseException as e:
+            self._put(e)
+        self._put(_END)
+
+    def _put(self, item: object) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @property
+    def depth(self) -> int:
+        """Number of blocks rendered and waiting to be used"""
+        return self._queue.qsize()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[np.ndarray]:
+        """Next block, None once they are all used. Raises `queue.Empty` after `timeout` seconds without a block"""
+        item = self._queue.get(timeout=timeout)
+        if item is _END:
+            # for the next calls
+            self._queue.put(_END)
+            return None
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def close(self) -> None:
+        """Stops the thread, a `get` waiting for a block (or called later) then returns None"""
+        self._stop.set()
+        self._thread.join()
+        # the thread is gone, so the end can take the place of the blocks left
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queue.put(_END)
+
+
+async def iterate_async(blocks: Iterator[np.ndarray], depth: int = 8) -> AsyncIterator[np.ndarray]:
+    """Iterates over `blocks` rendered by a `BackgroundRenderer`, without blocking the event loop"""
+    renderer = BackgroundRenderer(blocks, depth)
+    try:
+        while True:
+            block = await asyncio.to_thread(renderer.get)
+            if block is None:
+                return
+            yield block
+    finally:
+        # joining the thread may wait for the block being rendered
+        await asyncio.to_thread(renderer.close)
+
+
+class Player:
+    """
+    Plays a playable while it is rendered by a `BackgroundRenderer`, without blocking the caller.
+    Rendered blocks are handed to the mixer in chunks of about `CHUNK_TIME` seconds, one chunk being queued behind
+    the one playing. Every time the mixer runs out of sound before the next chunk is ready, an underrun is counted.
+    """
+
+    CHUNK_TIME = 0.1
+
+    def __init__(self, playable: Playable, block_size: int = BLOCK_SIZE, depth: int = 16):
+        self.playable = playable
+        self.block_size = block_size
+        self.depth = depth
+        self.channels = getattr(playable, "channels", 1)
+
+        self.underruns = 0
+        # first frame of the current playback and number of frames handed to the mixer since
+        self._first = 0
+        self._handed = 0
+
+        self._renderer: Optional[BackgroundRenderer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._resume = threading.Event()
+        self._resume.set()
+        self._channel: Optional[pygame.mixer.Channel] = None
+        self.error: Optional[BaseException] = None
+
+    def _blocks(self, start: float) -> Iterator[np.ndarray]:
+        output = mastering.OutputStage()
+        for block in self.playable.render_blocks(self.block_size, start):
+            yield output.process(block)
+        yield output.flush()
+
+    def start(self, position: float = 0.0) -> None:
+        """Starts playing from `position` seconds, rendering in the background"""
+        from .playables import init_mixer
+
+        self.stop()
+        init_mixer(self.channels)
+        self._first = round(position * SAMPLE_RATE)
+        self._handed = 0
+        self._stop.clear()
+        self._renderer = BackgroundRenderer(self._blocks(position), self.depth)
+        self._thread = threading.Thread(target=self._play, daemon=True)
+        self._thread.start()
+
+    def _play(self) -> None:
+        import pygame
+
+        chunk_frames = round(self.CHUNK_TIME * SAMPLE_RATE)
+        try:
+            while not self._stop.is_set():
+                chunk = self._next_chunk(chunk_frames)
+                if chunk is None:
+                    break
+                sound = pygame.sndarray.make_sound(chunk)
+
+                while self._channel is not None and self._channel.get_queue() is not None:
+                    if self._stop.wait(0.002):
+                        return
+                self._resume.wait()
+                if self._stop.is_set():
+                    return
+
+                if self._channel is None or not self._channel.get_busy():
+                    if self._channel is not None:
+                        self.underruns += 1
+                    self._channel = sound.play()
+                else:
+                    self._channel.queue(sound)
+                self._handed += chunk.shape[0]
+        except BaseException as e:
+            self.error = e
+
+    def _next_chunk(self, frames: int) -> Optional[np.ndarray]:
+        blocks = []
+        size = 0
+        while size < frames:
+            block = None
+            while not self._stop.is_set():
+                try:
+                    block = self._renderer.get(timeout=0.05)
+                    break
+                except queue.Empty:
+                    pass
+            if block is None:
+                break
+            blocks.append(block)
+            size += block.shape[0]
+        return np.ascontiguousarray(np.concatenate(blocks)) if size else None
+
+    def pause(self) -> None:
+        self._resume.clear()
+        if self._channel is not None:
+            self._channel.pause()
+
+    def resume(self) -> None:
+        if self._channel is not None:
+            self._channel.unpause()
+        self._resume.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._resume.is_set()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            # lets the thread see `_stop` if it waits for `resume`, the player stays paused
+            paused = self.paused
+            self._resume.set()
+            self._thread.join()
+            self._thread = None
+            if paused:
+                self._resume.clear()
+        if self._renderer is not None:
+            self._renderer.close()
+            self._renderer = None
+        if self._channel is not None:
+            self._channel.stop()
+            self._channel = None
+
+    def seek(self, position: float) -> None:
+        """Jumps to `position` seconds, staying paused if the player is paused"""
+        self.start(position)
+
+    @property
+    def playing(self) -> bool:
+        """Whether there is still something to play (even while paused)"""
+        return (self._thread is not None and self._thread.is_alive()) or (
+                self._channel is not None and self._channel.get_busy())
+
+    @property
+    def position(self) -> float:
+        """Position, in seconds, of the end of what was handed to the mixer (at most two chunks ahead of the sound)"""
+        return (self._first + self._handed) / SAMPLE_RATE
+
+    def wait(self) -> None:
+        """Blocks until the end of the playable"""
+        while self.playing:
+            self._stop.wait(0.01)
+
+    def stats(self) -> dict[str, Union[int, float]]:
+        return {
+            "queue_depth": 0 if self._renderer is None else self._renderer.depth,
+            "blocks_rendered": 0 if self._renderer is None else self._renderer.rendered,
+            "underruns": self.underruns,
+            "position": self.position,
+        }
+
+    def __enter__(self) -> Player:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
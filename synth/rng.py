@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import functools
+import threading
+from collections.abc import Iterator
+from typing import Optional, Union
+
+import numpy as np
+
+from .arena import writable
+from .constants import SAMPLE_RATE
+
+"""
+Module generating reproducible noise: the frames are split into chunks of `CHUNK_FRAMES` frames counted from the start
+of the sound, and every chunk has its own generator seeded with (seed, chunk index).
+The noise of a frame therefore only depends on the seed and on its position, whether the sound is rendered at once,
+block by block or in parallel.
+"""
+
+CHUNK_FRAMES = 1 << 14
+# rates of the scratch events: all the events below MIN_RATE are drawn at once, probabilities are capped at
+# 1 - exp(-MAX_RATE)
+MIN_RATE = 2.0 ** -16
+MAX_RATE = 8.0
+
+
+def make_seed(seed: Union[int, np.random.Generator, None] = None) -> int:
+    """Seed of a noisy effect or playable: a fresh random one if None, or drawn from a generator"""
+    if seed is None:
+        return int(np.random.SeedSequence().entropy)
+    if isinstance(seed, np.random.Generator):
+        return int(seed.integers(2 ** 63))
+    return int(seed)
+
+
+def _chunks(first: int, frames: int) -> Iterator[tuple[int, int, int, int]]:
+    """(chunk index, first frame in the chunk, first frame in the block, frames) of the chunks covering a block"""
+    position = first
+    while position < first + frames:
+        index, offset = divmod(position, CHUNK_FRAMES)
+        size = min(CHUNK_FRAMES - offset, first + frames - position)
+        yield index, offset, position - first, size
+        position += size
+
+
+@functools.lru_cache(maxsize=64)
+def _uniform_chunk(seed: int, index: int, channels: int) -> np.ndarray:
+    shape = (CHUNK_FRAMES,) if channels == 1 else (CHUNK_FRAMES, channels)
+    noise = np.random.default_rng([seed, index]).random(shape, dtype=np.float32)
+    noise.flags.writeable = False
+    return noise
+
+
+def _channels(sound: np.ndarray) -> int:
+    return int(np.prod(sound.shape[1:]))
+
+
+def add_uniform(sound: np.ndarray, seed: int, first: int, scale: Union[float, np.ndarray]) -> np.ndarray:
+    """
+    Adds uniform noise between 0 and `scale` to `sound`, whose frames start at frame `first`.
+    `scale` is a constant or one value per frame. Works in place when `sound` is a writable float32 array.
+    """
+    sound = writable(sound)
+    channels = _channels(sound)
+    # (frames, channels) views, whatever the shapes of the sound and of the scale
+    flat = sound.reshape(sound.shape[0], channels)
+    scale = np.reshape(scale, (-1, 1)) if np.ndim(scale) else np.float32(scale)
+    for index, offset, start, size in _chunks(first, sound.shape[0]):
+        noise = _uniform_chunk(seed, index, channels)[offset:offset + size].reshape(size, channels)
+        flat[start:start + size] += noise * (scale[start:start + size] if np.ndim(scale) else scale)
+    return sound
+
+
+class _ChunkEvents:
+    """
+    Scratch events of a chunk: random positions with random rates, drawn as needed from the lowest rates up
+    (first below `MIN_RATE`, then in strips doubling the highest rate), so the events already drawn never change.
+    """
+
+    def __init__(self, seed: int, index: int, channels: int):
+        self._rng = np.random.default_rng([seed, index, channels])
+        self._size = CHUNK_FRAMES * channels
+        self._lock = threading.Lock()
+        self.positions = np.empty(0, dtype=np.int64)
+        self.rates = np.empty(0)
+        self.values = np.empty(0, dtype=np.float32)
+        # every event with a rate below it is drawn
+        self.bound = 0.0
+
+    def up_to(self, rate: float) -> _ChunkEvents:
+        with self._lock:
+            while self.bound < rate:
+                low, high = self.bound, max(MIN_RATE, 2 * self.bound)
+                count = self._rng.poisson(self._size * (high - low))
+                self.positions = np.concatenate((self.positions, self._rng.integers(0, self._size, count)))
+                self.rates = np.concatenate((self.rates, low + self._rng.random(count) * (high - low)))
+                self.values = np.concatenate((self.values, self._rng.random(count, dtype=np.float32)))
+                self.bound = high
+        return self
+
+
+@functools.lru_cache(maxsize=256)
+def _chunk_events(seed: int, index: int, channels: int) -> _ChunkEvents:
+    return _ChunkEvents(seed, index, channels)
+
+
+def scatter(sound: np.ndarray, seed: int, first: int, probability: Union[float, np.ndarray],
+            scale: float) -> np.ndarray:
+    """
+    Replaces every sample of `sound` (whose frames start at frame `first`) by uniform noise between 0 and `scale`
+    with the given `probability`, a constant or one value per frame. Works in place when `sound` is a writable
+    float32 array.
+    Only the replaced samples are drawn: a sample is replaced if one of the events of its chunk falls on it with
+    a rate below -log(1 - probability), so blocks agree whatever the probabilities outside of them.
+    """
+    sound = writable(sound)
+    channels = _channels(sound)
+    flat = sound.reshape(sound.shape[0], channels)
+    rate = -np.log1p(-np.minimum(probability, 1 - np.exp(-MAX_RATE)))
+    bound = float(np.max(rate)) if np.size(rate) else 0.0
+    if bound <= 0:
+        return sound
+
+    for index, offset, start, size in _chunks(first, sound.shape[0]):
+        events = _chunk_events(seed, index, channels).up_to(bound)
+        frames, channel = np.divmod(events.positions, channels)
+        inside = (frames >= offset) & (frames < offset + size)
+        frames = frames[inside] + (start - offset)
+
+        hit = events.rates[inside] < (rate[frames] if np.ndim(rate) else rate)
+        flat[frames[hit], channel[inside][hit]] = events.values[inside][hit] * np.float32(scale)
+    return sound
+
+
+def first_frame(t: np.ndarray, sample_rate: Optional[int] = None) -> int:
+    """Index of the first frame of a block from its times"""
+    return round(float(t[0]) * (SAMPLE_RATE if sample_rate is None else sample_rate)) if t.shape[0] else 0
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from .cache import stable_hash
+from .constants import CACHE_DIR, SAMPLE_RATE
+
+"""
+Module storing decoded samples, so that every audio file is only decoded and resampled once.
+"""
+
+
+class SampleStore:
+    """
+    Decodes and resamples audio files once into raw float32 files, loaded back with `np.memmap`.
+    Every file is keyed on its path, modification time, offset and duration, and loaded samples are shared
+    (read-only) between all the `Sample`s using them.
+    Files are downmixed to mono unless `mono=False`, in which case they are loaded as (frames, channels) arrays.
+    """
+
+    def __init__(self, directory: Optional[Union[str, Path]] = None):
+        self.directory = CACHE_DIR / "samples" if directory is None else Path(directory)
+        self._loaded: dict[tuple, np.ndarray] = {}
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path: Union[str, Path], offset: float = 0.0, duration: Optional[float] = None, mono: bool = True) -> tuple:
+        path = Path(path).resolve()
+        stat = path.stat()
+        key = str(path), stat.st_mtime_ns, stat.st_size, float(offset), duration, SAMPLE_RATE
+        return key if mono else key + ("multichannel",)
+
+    def load(self, path: Union[str, Path], offset: float = 0.0, duration: Optional[float] = None,
+             mono: bool = True) -> np.ndarray:
+        key = self.key(path, offset, duration, mono)
+        data = self._loaded.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+
+        name = stable_hash(key)
+        # multichannel files have their number of channels in their name
+        file = self.directory / f"{name}.f32" if mono else next(self.directory.glob(f"{name}-*ch.f32"), None)
+        if file is not None and file.exists():
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            file = self._decode(path, offset, duration, mono, name)
+
+        channels = 1 if mono else int(file.name[len(name) + 1:-len("ch.f32")])
+        if file.stat().st_size:
+            data = np.memmap(file, dtype=np.float32, mode='r')
+        else:
+            data = np.zeros(0, dtype=np.float32)
+            data.flags.writeable = False
+        if not mono:
+            data = data.reshape(-1, channels)
+
+        self._loaded[key] = data
+        return data
+
+    def _decode(self, path: Union[str, Path], offset: float, duration: Optional[float], mono: bool,
+                name: str) -> Path:
+        from librosa import load as rosaload
+
+        data, _ = rosaload(path, sr=SAMPLE_RATE, mono=mono, offset=offset, duration=duration)
+        if mono:
+            file = self.directory / f"{name}.f32"
+        else:
+            # librosa gives (channels, frames)
+            data = np.atleast_2d(data).T
+            file = self.directory / f"{name}-{data.shape[1]}ch.f32"
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # written next to its final place then renamed, so that concurrent processes never read a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(np.ascontiguousarray(data, dtype=np.float32).tobytes())
+        os.replace(tmp, file)
+        return file
+
+    def clear(self) -> None:
+        """Forgets the samples loaded by this process, the files stay on disk"""
+        self._loaded.clear()
+
+
+_sample_store: Optional[SampleStore] = None
+
+
+def set_sample_store(store: SampleStore) -> None:
+    global _sample_store
+    _sample_store = store
+
+
+def get_sample_store() -> SampleStore:
+    global _sample_store
+    if _sample_store is None:
+        _sample_store = SampleStore()
+    return _sample_store
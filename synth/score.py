@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+from collections.abc import Iterable, Sequence
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from .constants import SAMPLE_RATE
+from .notes import Note, Timbre, Tone
+from .playables import Effect, Playable
+from .song import Song, mix_into
+
+"""
+Module containing the compiled form of a score: a table of note events, rendered without creating a `Note` per event.
+"""
+
+# one note of a score: its start and length (in seconds, release excluded), tone id, volume and index of its timbre
+EVENT = np.dtype([("start", np.float64), ("length", np.float64), ("tone", np.int16), ("velocity", np.float32),
+                  ("timbre", np.uint16)])
+
+# (beats, tone id or -1 for a rest) of every token already parsed, scores repeat the same few tokens a lot
+_TOKENS: dict[str, tuple[float, int]] = {}
+
+
+def _parse_token(token: str) -> tuple[float, int]:
+    parsed = _TOKENS.get(token)
+    if parsed is None:
+        if token.count('-') == len(token):
+            parsed = (float(len(token)), -1)
+        else:
+            beats, _, tone = token.rpartition('*')
+            parsed = (float(beats) if beats else 1.0, Tone.from_string(tone).id)
+        _TOKENS[token] = parsed
+    return parsed
+
+
+class Score(Playable):
+    """
+    Notes stored as an `EVENT` array sorted by start time, the timbre of every event being an index in `timbres`,
+    and its effects the same index in `timbre_effects`.
+    Events with the same timbre, tone, length and velocity are rendered once and mixed at every start.
+    """
+
+    # scores are not cached as a whole, their distinct notes are
+    cacheable = False
+
+    def __init__(self, events: np.ndarray, timbres: Sequence[Timbre],
+                 timbre_effects: Optional[Sequence[Sequence[Effect]]] = None, volume: float = 1.0,
+                 effects: Sequence[Effect] = None):
+        if events.dtype != EVENT:
+            raise ValueError(f"expected events of dtype {EVENT}, got {events.dtype}")
+        if events.shape[0] and events["timbre"].max() >= len(timbres):
+            raise ValueError(f"events use timbre {events['timbre'].max()} but only {len(timbres)} are given")
+
+        order = np.argsort(events["start"], kind="stable")
+        self.events = events if np.all(order[1:] > order[:-1]) else events[order]
+        self.timbres = list(timbres)
+        self.timbre_effects = [[] for _ in self.timbres] if timbre_effects is None else list(timbre_effects)
+
+        self.start = 0.0
+        releases = np.array([t.amplitude_enveloppe.release for t in self.timbres])
+        ends = self.events["start"] + self.events["length"] + releases[self.events["timbre"]]
+        self.length = float(ends.max()) if ends.shape[0] else 0.0
+        self.volume = volume
+        self.effects = [] if effects is None else effects
+
+    @classmethod
+    def parse(cls, bpm: float, lines: Iterable[tuple[Timbre, str, Sequence[Effect]]]) -> Score:
+        """Parses the lines given to `Song.from_lines`, each line getting its own timbre index"""
+        timbres, timbre_effects, tables = [], [], []
+        for timbre, text, line_effects in lines:
+            parsed = np.array([_parse_token(token) for token in text.split()], dtype=np.float64).reshape(-1, 2)
+            beats, tones = parsed[:, 0], parsed[:, 1]
+            notes = tones >= 0
+
+            table = np.empty(np.count_nonzero(notes), dtype=EVENT)
+            starts = np.concatenate(([0.0], np.cumsum(beats)[:-1]))
+            table["start"] = starts[notes] * 60 / bpm
+            table["length"] = beats[notes] * 60 / bpm
+            table["tone"] = tones[notes]
+            table["velocity"] = 1.0
+            table["timbre"] = len(timbres)
+
+            timbres.append(timbre)
+            timbre_effects.append(line_effects)
+            tables.append(table)
+
+        events = np.concatenate(tables) if tables else np.empty(0, dtype=EVENT)
+        return cls(events, timbres, timbre_effects)
+
+    def __len__(self) -> int:
+        return self.events.shape[0]
+
+    def notes(self) -> list[Note]:
+        """One `Note` per event, for a `Song`"""
+        tones: dict[int, Tone] = {}
+        notes = []
+        for start, length, tone, velocity, timbre in self.events.tolist():
+            if tone not in tones:
+                tones[tone] = Tone(tone)
+            notes.append(Note(tones[tone], self.timbres[timbre], start=start, length=length, volume=velocity,
+                              effects=self.timbre_effects[timbre]))
+        return notes
+
+    def distinct_notes(self) -> tuple[list[Note], np.ndarray]:
+        """
+        One `Note` (starting at 0) per distinct timbre, tone, length and velocity, and the index of the note of
+        every event. Events whose effects cannot be cached (e.g. random ones) all get their own note.
+        """
+        keys = np.empty(self.events.shape[0], dtype=[("timbre", np.uint16), ("tone", np.int16),
+                                                     ("length", np.float64), ("velocity", np.float32),
+                                                     ("event", np.int64)])
+        for name in ("timbre", "tone", "length", "velocity"):
+            keys[name] = self.events[name]
+        shared = np.array([all(e.cacheable for e in effects) for effects in self.timbre_effects], dtype=bool)
+        keys["event"] = np.where(shared[self.events["timbre"]], -1, np.arange(self.events.shape[0]))
+
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        notes = [Note(Tone(int(e["tone"])), self.timbres[e["timbre"]], length=float(e["length"]),
+                      volume=float(e["velocity"]), effects=self.timbre_effects[e["timbre"]])
+                 for e in self.events[first]]
+        return notes, inverse.ravel()
+
+    def generate_raw(self, t: np.ndarray) -> np.ndarray:
+        samples = np.zeros(t.shape[0], dtype=np.float32)
+        notes, inverse = self.distinct_notes()
+        rendered = {id(n): sound for n, sound in Song.render_playables(notes)}
+        sounds = [rendered[id(n)] for n in notes]
+
+        starts = np.round(self.events["start"] * SAMPLE_RATE).astype(np.int64)
+        for start, i in zip(starts.tolist(), inverse.tolist()):
+            mix_into(samples, 0, sounds[i], start)
+        return samples
+
+    def save_events(self, path: Union[str, Path]) -> None:
+        """Writes the events (not the timbres) as a `.npy` file"""
+        with open(path, "wb") as f:
+            np.save(f, self.events)
+
+    @classmethod
+    def load_events(cls, path: Union[str, Path], timbres: Sequence[Timbre],
+                    timbre_effects: Optional[Sequence[Sequence[Effect]]] = None, *, mmap: bool = False,
+                    **kwargs) -> Score:
+        """Reads the events written by `save_events`, with the timbres (and effects) they were made with"""
+        return cls(np.load(path, mmap_mode="r" if mmap else None), timbres, timbre_effects, **kwargs)
@@ -0,0 +1,344 @@
+from __future__ import annotations
+
+import argparse
+import importlib
+import json
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
+
+"""
+Module of the render service: a long-lived process rendering jobs given as JSON lines (on stdin or a Unix socket)
+with a pool of warm worker processes, so that `synth`, scipy and librosa are only imported once per worker.
+The workers share the on-disk sample store. Their render cache and transpositions are kept in memory, or also on disk
+(where nothing is ever evicted) under the directory given by `--cache-dir`, e.g. `CACHE_DIR`.
+
+    python -m synth.service [--workers N] [--socket PATH] [--cache-bytes N] [--cache-dir PATH] [--no-warm-up]
+
+A job is a JSON object, every key but `output` being optional:
+
+    {"id": "sting-1", "output": "out/sting-1.wav", "format": "int16", "bpm": 240, "volume": 1.0, "channels": 1,
+     "lines": [{"timbre": TIMBRE, "notes": "C4 E4 2*G4", "effects": [EFFECT, ...]}],
+     "samples": [{"path": "samples/kick.wav", "start": 0.0, "offset": 0.0, "length": null, "volume": 1.0,
+                  "transpose": 0, "method": null, "mono": true, "pan": 0.0, "effects": [EFFECT, ...]}],
+     "effects": [EFFECT, ...]}
+
+    TIMBRE = {"amplitude": ENVELOPE, "pitch": ENVELOPE,
+              "harmonics": [{"frequency": 1, "amplitude": 1.0, "oscillator": OSCILLATOR}, ...]}
+    OSCILLATOR = "sine" | "square" | "triangle" | "sawtooth" | {"type": "Pulse", "width": 0.25}
+                 | {"type": "Wavetable", "oscillator": OSCILLATOR, "interpolation": "linear"}
+    ENVELOPE = {"attack": 0.02, "decay": 0.05, "sustain": 0.7, "release": 0.1, "level": 1.0}
+    EFFECT = {"type": "LowPassFilter", "cutout": 880, "resonance": {"type": "LFO", "frequency": 2, "amplitude": 0.2}}
+
+Samples are transposed with `method` ("rubberband" or "resample", see `Sample.transposed`), the default method of
+`pitch.PitchShifter` (rubberband) if null, as in the library. Effects and modulators are built from the classes of
+`synth.effects` and `synth.effects.modulators` named by `type`.
+Every job gets one JSON line back, in completion order:
+
+    {"id": "sting-1", "status": "ok", "output": "...", "frames": 88200, "worker": 1234,
+     "queued": 0.001, "build": 0.002, "render": 0.05, "save": 0.003, "seconds": 0.056}
+
+with `"status": "error"` and an `"error"` message instead when the job failed.
+"""
+
+
+class JobError(ValueError):
+    """Raised for an invalid job spec"""
+
+
+def _envelope(spec: Optional[dict]) -> Any:
+    from .notes import ADSR
+
+    if spec is None:
+        return ADSR(attack=0.0, decay=0.0, sustain=0.0, release=0.0, level=1)
+    return ADSR(**spec)
+
+
+# oscillators of `synth.oscillators` a job can name, `Pulse` and `Wavetable` being given as objects
+OSCILLATORS = ("sine", "square", "triangle", "sawtooth")
+
+
+def _oscillator(spec: Any) -> Any:
+    from . import oscillators
+
+    if isinstance(spec, str) and spec in OSCILLATORS:
+        return getattr(oscillators, spec)
+    if isinstance(spec, dict) and spec.get("type") in ("Pulse", "Wavetable"):
+        kwargs = {k: v for k, v in spec.items() if k != "type"}
+        try:
+            if spec["type"] == "Pulse":
+                return oscillators.Pulse(**kwargs)
+            return oscillators.Wavetable(_oscillator(kwargs.pop("oscillator", "sawtooth")), **kwargs)
+        except (TypeError, ValueError) as e:
+            raise JobError(f"invalid {spec['type']}: {e}") from None
+    name = spec.get("type") if isinstance(spec, dict) else spec
+    raise JobError(f"unknown oscillator '{name}', expected one of {', '.join(OSCILLATORS)}, Pulse or Wavetable")
+
+
+def _timbre(spec: dict) -> Any:
+    from .notes import Harmonic, Timbre
+
+    harmonics = [Harmonic(frequency=h["frequency"], amplitude=h["amplitude"],
+                          oscillator=_oscillator(h.get("oscillator", "sine")))
+                 for h in spec.get("harmonics", [{"frequency": 1, "amplitude": 1.0}])]
+
+    if "amplitude" not in spec:
+        raise JobError("a timbre needs an amplitude envelope")
+    return Timbre(pitch_enveloppe=_envelope(spec.get("pitch")), amplitude_enveloppe=_envelope(spec["amplitude"]),
+                  harmonics=harmonics)
+
+
+def _build(spec: Any, base: type, namespace: Any) -> Any:
+    """Builds the `base` subclass of `namespace` named by the `type` of `spec`, and the modulators of its arguments"""
+    from .effects import modulators
+
+    kwargs = {k: _build(v, modulators.EffectModulator, modulators) if isinstance(v, dict) else v
+              for k, v in spec.items() if k != "type"}
+    cls = getattr(namespace, str(spec.get("type")), None)
+    if not (isinstance(cls, type) and issubclass(cls, base)) or cls.__name__.startswith("_"):
+        raise JobError(f"unknown {base.__name__} '{spec.get('type')}'")
+    return cls(**kwargs)
+
+
+def _effects(specs: Iterable[dict]) -> list:
+    from . import effects
+
+    return [_build(e, effects.Effect, effects) for e in specs]
+
+
+def build(job: dict) -> Any:
+    """The playable rendered by a job"""
+    from .playables import Sample
+    from .score import Score
+    from .song import Song
+
+    playables = []
+    lines = job.get("lines", [])
+    if lines:
+        score = Score.parse(job.get("bpm", 120), [(_timbre(line["timbre"]), line["notes"],
+                                                    _effects(line.get("effects", []))) for line in lines])
+        playables += score.notes()
+
+    for spec in job.get("samples", []):
+        sample = Sample(spec["path"], offset=spec.get("offset", 0.0), start=spec.get("start", 0.0),
+                        length=spec.get("length"), volume=spec.get("volume", 1.0),
+                        effects=_effects(spec.get("effects", [])), mono=spec.get("mono", True))
+        if spec.get("transpose"):
+            sample = sample.transposed(spec["transpose"], spec.get("method"))
+        sample.pan = spec.get("pan", 0.0)
+        playables.append(sample)
+
+    if not playables:
+        raise JobError("the job has neither lines nor samples")
+    return Song(playables, volume=job.get("volume", 1.0), effects=_effects(job.get("effects", [])),
+                channels=job.get("channels", 1))
+
+
+def render(job: dict) -> dict[str, Any]:
+    """Renders a job in the current process, returning its report"""
+    begin = time.perf_counter()
+    report: dict[str, Any] = {"id": job.get("id"), "worker": os.getpid()}
+    if "submitted" in job:
+        report["queued"] = time.time() - job["submitted"]
+    try:
+        if "output" not in job:
+            raise JobError("the job has no output")
+        song = build(job)
+        built = time.perf_counter()
+
+        sound = song.render()
+        rendered = time.perf_counter()
+
+        output = Path(job["output"])
+        output.parent.mkdir(parents=True, exist_ok=True)
+        sample_format = job.get("format", "int16")
+        song.save(song.master(sound, sample_format), output, sample_format)
+        saved = time.perf_counter()
+
+        report.update(status="ok", output=str(output), frames=int(sound.shape[0]), build=built - begin,
+                      render=rendered - built, save=saved - rendered)
+    except Exception as e:
+        report.update(status="error", error=f"{type(e).__name__}: {e}")
+    report["seconds"] = time.perf_counter() - begin
+    return report
+
+
+def warm_up(cache_bytes: int, directory: Optional[Path] = None, imports: bool = True) -> None:
+    """
+    Sets up a worker: caches (also on disk, shared by the workers, if `directory` is given), and (with `imports`)
+    the imports and first calls every render would otherwise pay for.
+    """
+    import numpy as np
+
+    from . import cache, pitch, samples, wavfile
+    from .constants import SAMPLE_RATE
+
+    cache.set_render_cache(cache.RenderCache(cache_bytes, None if directory is None else directory / "render"))
+    # same default method as the library, only the caches change
+    pitch.set_pitch_shifter(pitch.PitchShifter(max_bytes=cache_bytes // 4,
+                                               directory=None if directory is None else directory / "pitch"))
+    if not imports:
+        return
+
+    # used by the filters
+    importlib.import_module("scipy.signal")
+    # librosa loads its decoder and resampler lazily: a short file at another sample rate is decoded and resampled
+    # once, in a store of its own so that the shared one is left alone
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "warm-up.wav"
+        wavfile.write(path, np.zeros(SAMPLE_RATE // 20, dtype=np.int16), sample_rate=SAMPLE_RATE // 2)
+        try:
+            samples.SampleStore(tmp).load(path)
+        except ImportError:
+            pass
+    # the first render fills the lazy tables of the oscillators and envelopes
+    build({"lines": [{"timbre": {"amplitude": {"attack": 0.01, "decay": 0.01, "sustain": 0.5, "release": 0.01}},
+                      "notes": "C4"}]}).render()
+
+
+class RenderService:
+    """
+    Renders jobs on `workers` warm processes, calling `on_result` with the report of every job once done.
+    The caches of the workers are only kept in memory, unless `directory` is given.
+    """
+
+    def __init__(self, workers: Optional[int] = None, cache_bytes: int = 256 * 2 ** 20,
+                 directory: Optional[Path] = None, warm: bool = True):
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = ProcessPoolExecutor(self.workers, initializer=warm_up, initargs=(cache_bytes, directory, warm))
+        self._pending: set[Future] = set()
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+
+    def submit(self, job: dict, on_result: Callable[[dict], None]) -> Future:
+        """Queues a job, the returned future giving its report once `on_result` has been called with it"""
+        job = dict(job, submitted=time.time())
+        reported: Future = Future()
+        with self._lock:
+            self._pending.add(reported)
+            self.submitted += 1
+
+        def done(f: Future) -> None:
+            try:
+                report = f.result()
+            except Exception as e:  # the worker died
+                report = {"id": job.get("id"), "status": "error", "error": f"{type(e).__name__}: {e}"}
+            try:
+                on_result(report)
+            finally:
+                with self._lock:
+                    self._pending.discard(reported)
+                    self.completed += 1
+                reported.set_result(report)
+
+        self._pool.submit(render, job).add_done_callback(done)
+        return reported
+
+    def wait(self) -> None:
+        """Blocks until every job submitted so far is done"""
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                return
+            for f in pending:
+                f.result()
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self) -> RenderService:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.wait()
+        self.close()
+
+
+def _writer(send: Callable[[str], None]) -> Callable[[dict], None]:
+    """Writes reports as JSON lines with `send`, one at a time as they come from several threads"""
+    lock = threading.Lock()
+
+    def write(report: dict) -> None:
+        with lock:
+            send(json.dumps(report) + "\n")
+    return write
+
+
+def serve_lines(service: RenderService, lines: Iterable[str], write: Callable[[dict], None]) -> list[Future]:
+    """Submits every JSON line of `lines` as a job, reporting invalid lines right away"""
+    futures = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise JobError("a job must be a JSON object")
+        except ValueError as e:
+            write({"id": None, "status": "error", "error": f"{type(e).__name__}: {e}"})
+            continue
+        futures.append(service.submit(job, write))
+    return futures
+
+
+def _stdout(text: str) -> None:
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+def serve_socket(service: RenderService, path: str) -> None:
+    """Accepts connections on a Unix socket, each one sending jobs and receiving their reports as JSON lines"""
+    class Handler(socketserver.StreamRequestHandler):
+        def send(self, text: str) -> None:
+            try:
+                self.wfile.write(text.encode())
+                self.wfile.flush()
+            except OSError:  # the client left, its remaining reports are dropped
+                pass
+
+        def handle(self) -> None:
+            futures = serve_lines(service, (raw.decode() for raw in self.rfile), _writer(self.send))
+            # the connection stays open until the reports of its jobs are sent
+            for f in futures:
+                f.result()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m synth.service",
+                                     description="Renders jobs given as JSON lines on warm worker processes")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--socket", help="listen on this Unix socket instead of reading stdin")
+    parser.add_argument("--cache-bytes", type=int, default=256 * 2 ** 20,
+                        help="memory of the render cache of every worker")
+    parser.add_argument("--cache-dir", type=Path, default=None,
+                        help="also keep the render cache and transpositions in this directory (never evicted)")
+    parser.add_argument("--no-warm-up", dest="warm", action="store_false", help="skip the warm-up of the workers")
+    args = parser.parse_args(argv)
+
+    with RenderService(args.workers, args.cache_bytes, args.cache_dir, args.warm) as service:
+        if args.socket:
+            serve_socket(service, args.socket)
+        else:
+            serve_lines(service, sys.stdin, _writer(_stdout))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,74 +1,451 @@
 from __future__ import annotations
 
-from collections.abc import Sequence
-from typing import Union, Iterable
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from collections.abc import Iterator, Sequence
+from multiprocessing import shared_memory
+from typing import Iterable, Optional, Union
 
 import numpy as np
 
-from .constants import SAMPLE_RATE, MAX_AMPLITUDE
-from .notes import Timbre, Tone, Note
-from .playables import Playable, Effect
+from . import cache, telemetry, wavfile
+from .constants import BLOCK_SIZE, SAMPLE_RATE
+from .effects import modulators
+from .intervals import IntervalIndex
+from .notes import Timbre, Note
+from .playables import Playable, Effect, init_mixer
 
 
 class Song(Playable):
-    def __init__(self, playables: Sequence[Playable], volume: float = 1.0, effects: Sequence[Effect] = None):
-        self.playables = sorted(playables, key=lambda x: x.start)
-        self.length = max(map(lambda x: x.start + x.length, self.playables))
+    # songs are not cached as a whole, their playables are
+    cacheable = False
+    # length of the time slices rendered by each worker when `workers > 1`
+    SLICE_LENGTH = 2.0
+
+    def __init__(self, playables: Sequence[Playable], volume: float = 1.0, effects: Sequence[Effect] = None,
+                 workers: int = 1, channels: int = 1, incremental: bool = False):
+        self.index = IntervalIndex(playables)
+        self.length = self.index.end
         self.volume = volume
         self.effects = [] if effects is None else effects
+        # number of processes rendering the playables in `generate`
+        self.workers = workers
+        # the song is rendered as (frames, channels) if `channels > 1`, each playable being placed with its `pan`
+        self.channels = channels
 
         self.min_buffer_time = 1.0
         self.extra_time = 1.0
 
         self.time_generated = 0.0
 
+        # whether `generate_raw` keeps the last mix and only mixes again the parts of the song that changed,
+        # at the cost of a float32 copy of the whole mix kept on the song (about 10 MB per minute and channel)
+        self.incremental = incremental
+        self._mix: Optional[np.ndarray] = None
+        # playable and `_fingerprint` of everything in `_mix`, by id
+        self._mixed: dict[int, tuple[Playable, tuple]] = {}
+        # ids of the playables changed in a way their fingerprint does not show, see `update`
+        self._stale: set[int] = set()
+
+    @property
+    def playables(self) -> list[Playable]:
+        """Playables of the song, sorted by start time"""
+        return self.index.items
+
+    @playables.setter
+    def playables(self, playables: Sequence[Playable]) -> None:
+        self.index = IntervalIndex(playables)
+        self.length = self.index.end
+
+    def _refresh_index(self) -> None:
+        """Sorts the index again if playables were moved in place since they were indexed"""
+        if self.index.refresh():
+            self.length = self.index.end
+
     def add(self, playable: Union[Playable, Sequence[Playable]]) -> None:
-        if isinstance(playable, Sequence):
-            self.playables.extend(playable)
-        else:
-            self.playables.append(playable)
+        for p in (playable if isinstance(playable, Sequence) else [playable]):
+            self.index.add(p)
+
+        self.length = self.index.end
+
+    def remove(self, playable: Union[Playable, Sequence[Playable]]) -> None:
+        self._refresh_index()
+        for p in (playable if isinstance(playable, Sequence) else [playable]):
+            self.index.remove(p)
 
-        self.length = max(map(lambda x: x.start + x.length, self.playables))
+        self.length = self.index.end
 
+    def update(self, playable: Union[Playable, Sequence[Playable]]) -> None:
+        """
+        Tells the song that playables were changed in place, so that the next (incremental) render mixes them again.
+        Changes of their placement (picked up by the index on the next render, `between` or `remove`) and of
+        everything their `cache_key` hashes (their public attributes and those of their effects, timbre...) are found
+        without it, and playables without a cache key are always mixed again: it is only needed after changes of
+        private state.
+        """
+        for p in (playable if isinstance(playable, Sequence) else [playable]):
+            self._stale.add(id(p))
+        self._refresh_index()
+
+    def between(self, start: float, end: float) -> list[Playable]:
+        """Playables playing at some point between `start` and `end` (in seconds), sorted by start time"""
+        self._refresh_index()
+        return self.index.overlapping(start, end)
+
+    def _buffer(self, frames: int) -> np.ndarray:
+        return np.zeros((frames,) if self.channels == 1 else (frames, self.channels), dtype=np.float32)
+
+    def render_window(self, start: float, end: float) -> np.ndarray:
+        """Renders the part of the song between `start` and `end` (in seconds), as float32 scaled by `volume`"""
+        return self._render_range(round(start * SAMPLE_RATE), round(end * SAMPLE_RATE))
+
+    def _render_range(self, start: int, stop: int) -> np.ndarray:
+        samples = self._mix_range(start, stop)
+        samples *= self.volume
+        return samples
+
+    def _mix_range(self, start: int, stop: int) -> np.ndarray:
+        samples = self._buffer(stop - start)
+        # one sample of margin, the playables are placed on the closest sample of their start
+        playables = self.index.overlapping((start - 1) / SAMPLE_RATE, (stop + 1) / SAMPLE_RATE)
+        for p, sound in self.render_playables(playables):
+            mix_into(samples, start, sound, round(SAMPLE_RATE * p.start), p.channel_gains(self.channels))
+            self.time_generated = max(self.time_generated, p.start)
+        return samples
+
+    @telemetry.profiled("generate_raw")
     def generate_raw(self, t) -> np.ndarray:
-        samples = np.zeros(t.shape, dtype=np.int16)
+        self._refresh_index()
+        fingerprints = None
+        if self.incremental:
+            memo: dict[int, str] = {}
+            fingerprints = {id(p): _fingerprint(p, memo) for p in self.playables}
+
+        if self.incremental and self._mix is not None:
+            samples = self._update_mix(t.shape[0], fingerprints)
+        else:
+            self.time_generated = 0.0
+            samples = self._mix_parallel(t.shape[0]) if self.workers > 1 else self._mix_range(0, t.shape[0])
+
+        if self.incremental:
+            self._mix = samples
+            self._mixed = {id(p): (p, fingerprints[id(p)]) for p in self.playables}
+            self._stale.clear()
+        return samples * self.volume
+
+    def _update_mix(self, total: int, fingerprints: dict[int, tuple]) -> np.ndarray:
+        """
+        Mixes again the frames of `_mix` covered by the playables added, removed or changed since it was mixed,
+        each dirty window being mixed from scratch with everything playing in it.
+        `fingerprints` are the current `_fingerprint`s of the playables, by id.
+        """
+        windows = []
+        current = {id(p): p for p in self.playables}
+        for key, (p, fingerprint) in self._mixed.items():
+            if current.get(key) is not p or key in self._stale or fingerprints[key] != fingerprint:
+                windows.append(_frames(fingerprint))
+        for key, p in current.items():
+            mixed = self._mixed.get(key)
+            if mixed is None or mixed[0] is not p or key in self._stale or fingerprints[key] != mixed[1]:
+                windows.append(_frames(fingerprints[key]))
+
+        samples = self._mix
+        if samples.shape[0] != total:
+            samples = self._buffer(total)
+            kept = min(total, self._mix.shape[0])
+            samples[:kept] = self._mix[:kept]
+            windows.append((kept, total))
+
+        for start, stop in _merge(windows, total):
+            samples[start:stop] = self._mix_range(start, stop)
+        self.time_generated = self.length
+        return samples
+
+    def generate_raw_parallel(self, t) -> np.ndarray:
+        self._refresh_index()
+        return self._mix_parallel(t.shape[0]) * self.volume
+
+    def _mix_parallel(self, total: int) -> np.ndarray:
+        """
+        Mixes the song over a pool of `workers` processes, in time slices of `SLICE_LENGTH` seconds. Every playable is
+        sent to and rendered by the worker of the slice it starts in, which writes the frames of its slice straight
+        into a shared memory buffer (each slice owning its range) and returns the rest of its mix, the ends of the
+        playables still playing after the slice. These are added in the order of the slices, and the slices do not
+        depend on the number of workers, so neither does the result.
+        Starting the processes and sending them the playables has a cost: `workers > 1` pays off for songs lasting
+        many slices whose playables are slow to render (many harmonics, filters...), not for short or light songs.
+        """
+        slice_size = round(self.SLICE_LENGTH * SAMPLE_RATE)
+        count = max(-(-total // slice_size), 1)
+        slices: list[list[Playable]] = [[] for _ in range(count)]
         for p in self.playables:
-            sampled_start = round(SAMPLE_RATE * p.start)
+            slices[min(max(round(SAMPLE_RATE * p.start) // slice_size, 0), count - 1)].append(p)
+
+        shape = self._buffer(0).shape[1:]
+        tasks = [(k * slice_size, total if k == count - 1 else (k + 1) * slice_size, s)
+                 for k, s in enumerate(slices) if s]
+        memory = shared_memory.SharedMemory(create=True,
+                                            size=max(total * self.channels * np.dtype(np.float32).itemsize, 1))
+        try:
+            with ProcessPoolExecutor(self.workers) as pool:
+                rests = list(pool.map(_render_slice, [(memory.name, (total,) + shape) + task for task in tasks]))
+
+            shared = np.ndarray((total,) + shape, dtype=np.float32, buffer=memory.buf)
+            samples = shared.copy()
+            del shared
+        finally:
+            memory.close()
+            memory.unlink()
+
+        for start, rest in rests:
+            samples[start:start + rest.shape[0]] += rest
+        self.time_generated = self.length
+        return samples
+
+    @staticmethod
+    def render_playables(playables: Sequence[Playable]) -> Iterator[tuple[Playable, np.ndarray]]:
+        """
+        Renders every playable, rendering notes that share a timbre together with `Note.render_batch`.
+        The results are yielded one timbre at a time, not in the order of `playables`.
+        """
+        render_cache = cache.get_render_cache()
+        memo: dict[int, str] = {}
+
+        batches: dict[int, list[Note]] = {}
+        keys: dict[int, Optional[str]] = {}
+        for p in playables:
+            if type(p) is not Note:
+                yield p, p.render()
+                continue
+
+            if render_cache is not None:
+                key = keys[id(p)] = p.cache_key(memo)
+                sound = None if key is None else render_cache.get(key)
+                if sound is not None:
+                    yield p, sound
+                    continue
+            batches.setdefault(id(p.timbre), []).append(p)
 
-            samples[sampled_start:round(sampled_start + p.length * SAMPLE_RATE)] += p.generate()
-            samples.clip(-MAX_AMPLITUDE, MAX_AMPLITUDE)
+        for notes in batches.values():
+            if render_cache is None:
+                yield from zip(notes, Note.render_batch(notes))
+                continue
 
-            self.time_generated = p.start
+            # identical notes of the batch are only rendered once
+            unique: dict[Union[str, int], Note] = {}
+            for n in notes:
+                unique.setdefault(keys[id(n)] or id(n), n)
+            sounds = dict(zip(unique, Note.render_batch(list(unique.values()))))
+            for k, sound in sounds.items():
+                if isinstance(k, str):
+                    sounds[k] = render_cache.put(k, sound)
+            for n in notes:
+                yield n, sounds[keys[id(n)] or id(n)]
 
-        return (samples * self.volume).astype(np.int16)
+    def render_blocks(self, block_size: int = BLOCK_SIZE, start: float = 0.0) -> Iterator[np.ndarray]:
+        """
+        Renders the song block by block as float32, rendering each playable only once the block it starts in is reached
+        and dropping it as soon as it finished playing. Song-level effects are applied with `Effect.process_block`.
+        Unlike `render`, the mix is not normalized as a whole: each playable is normalized on its own.
+        Rendering begins at `start` seconds, the playables already playing there being picked with the interval index.
+        """
+        self._refresh_index()
+        for e in self.effects:
+            e.reset()
+        total = round(self.length * SAMPLE_RATE)
+        # the song is rendered a bit longer to flush the delay of the effects, which is then cut from the start
+        latency = sum(e.latency for e in self.effects)
+
+        to_skip = latency
+        for block_start, block in self._mix_blocks(total + latency, block_size, round(start * SAMPLE_RATE)):
+            t = np.arange(block_start, block_start + block.shape[0]) / SAMPLE_RATE
+            with modulators.evaluation(t):
+                for e in self.effects:
+                    block = e.process_block(t, block, self)
+
+            if to_skip:
+                skipped = min(to_skip, block.shape[0])
+                block, to_skip = block[skipped:], to_skip - skipped
+                if not block.shape[0]:
+                    continue
+            yield block
+
+    def _mix_blocks(self, total: int, block_size: int, first: int = 0) -> Iterator[tuple[int, np.ndarray]]:
+        playables = self.playables
+        # playables started before `first` and still playing, the others are picked block by block
+        i = self.index.first_from((first - 0.5) / SAMPLE_RATE)
+        playing = [p for p in self.index.overlapping((first - 1) / SAMPLE_RATE, first / SAMPLE_RATE)
+                   if round(SAMPLE_RATE * p.start) < first]
+        active: list[tuple[int, np.ndarray, Optional[np.ndarray]]] = [
+            (round(SAMPLE_RATE * p.start), sound, p.channel_gains(self.channels))
+            for p, sound in self.render_playables(playing)
+        ]
+        self.time_generated = first / SAMPLE_RATE
+        for block_start in range(first, total, block_size):
+            block_end = min(block_start + block_size, total)
+            j = i
+            while j < len(playables) and round(SAMPLE_RATE * playables[j].start) < block_end:
+                j += 1
+            for p, sound in self.render_playables(playables[i:j]):
+                active.append((round(SAMPLE_RATE * p.start), sound, p.channel_gains(self.channels)))
+            i = j
+
+            block = self._buffer(block_end - block_start)
+            still_active = []
+            for start, sound, gains in active:
+                mix_into(block, block_start, sound, start, gains)
+                if start + sound.shape[0] > block_end:
+                    still_active.append((start, sound, gains))
+            active = still_active
+
+            self.time_generated = min(block_end, round(self.length * SAMPLE_RATE)) / SAMPLE_RATE
+            block *= self.volume
+            yield block_start, block
+
+    def generate_blocks(self, block_size: int = BLOCK_SIZE) -> Iterator[np.ndarray]:
+        """
+        Streams the song as int16 blocks, quantized by a single `OutputStage`.
+        The limiter delays the output a bit, so block sizes are not exactly `block_size`.
+        """
+        return self.master_blocks(self.render_blocks(block_size))
+
+    def play_stream(self, block_size: int = BLOCK_SIZE, *, debug: bool = False) -> None:
+        """
+        Plays the song while it is being rendered.
+        Playback starts once `min_buffer_time` seconds are rendered, and rendering never gets more than
+        `min_buffer_time + extra_time` seconds ahead of what was handed to the mixer.
+        """
+        pygame = init_mixer(self.channels)
+        start_frames = max(block_size, round(self.min_buffer_time * SAMPLE_RATE))
+        frames = start_frames + round(self.extra_time * SAMPLE_RATE) + block_size
+        pending = np.empty((frames,) + self._buffer(0).shape[1:], dtype=np.int16)
+        filled = 0
+        channel = None
+
+        def flush(wait: bool) -> pygame.mixer.Channel:
+            nonlocal filled
+            if channel is not None:
+                while wait and channel.get_queue() is not None:
+                    pygame.time.wait(1)
+                if channel.get_queue() is not None:
+                    return channel
+
+            sound = pygame.sndarray.make_sound(pending[:filled])
+            filled = 0
+            if channel is None:
+                if debug:
+                    print("Started playing...")
+                return sound.play()
+            channel.queue(sound)
+            return channel
+
+        for block in self.generate_blocks(block_size):
+            pending[filled:filled + block.shape[0]] = block
+            filled += block.shape[0]
+            if filled > pending.shape[0] - block_size:
+                channel = flush(True)
+            elif filled >= start_frames:
+                channel = flush(channel is None)
+
+        if filled:
+            channel = flush(True)
+        while channel is not None and channel.get_busy():
+            pygame.time.wait(1)
+        if debug:
+            print("Finished playing!")
+
+    def save_stream(self, path: Union[str, pathlib.Path], block_size: int = BLOCK_SIZE,
+                    sample_format: str = "int16") -> None:
+        """Renders the song block by block straight into a memory-mapped WAV file"""
+        blocks = self.master_blocks(self.render_blocks(block_size), sample_format)
+        with wavfile.WavMemmap(path, round(self.length * SAMPLE_RATE), self.channels, sample_format) as f:
+            start = 0
+            for block in blocks:
+                f.write(start, block)
+                start += block.shape[0]
 
     @classmethod
     def from_lines(cls, bpm: int, lines: Iterable[tuple[Timbre, str, Sequence[Effect]]]) -> Song:
-        notes = []
-        for line in lines:
-            timbre = line[0]
-            line_notes = line[1].split()
-            t = 0.0
-            for n in line_notes:
-                if n.count('-') == len(n):
-                    t += n.count('-')
-                    continue
+        # imported here as scores are rendered with `Song.render_playables`
+        from .score import Score
+
+        return cls(Score.parse(bpm, lines).notes())
+
+
+def mix_into(samples: np.ndarray, start: int, sound: np.ndarray, sound_start: int,
+             gains: Optional[np.ndarray] = None) -> None:
+    """
+    Adds to `samples` (the samples of the song from sample `start`) the part of `sound` overlapping it,
+    `sound` starting at sample `sound_start` of the song, with the `gains` of every channel of `samples`.
+    Mono sounds are spread over all the channels by broadcasting, sounds with other channel counts are downmixed.
+    """
+    lo, hi = max(start, sound_start), min(start + samples.shape[0], sound_start + sound.shape[0])
+    if lo >= hi:
+        return
+
+    part = sound[lo - sound_start:hi - sound_start]
+    if part.ndim > 1 and part.shape[1:] != samples.shape[1:]:
+        part = part.mean(axis=1)
+    if part.ndim < samples.ndim:
+        part = part[:, None]
+    if gains is not None:
+        part = part * (gains[0] if samples.ndim == 1 else gains)
+    samples[lo - start:hi - start] += part
+
+
+def _fingerprint(p: Playable, memo: Optional[dict[int, str]] = None) -> tuple:
+    """
+    What the part of a playable in the mix depends on: its frames, placement and `cache_key`, which hashes
+    everything its render depends on. Playables without a cache key never match their previous fingerprint.
+    """
+    start = round(SAMPLE_RATE * p.start)
+    key = p.cache_key(memo)
+    return (start, start + round(SAMPLE_RATE * p.length), p.pan if isinstance(p.pan, (int, float)) else tuple(p.pan),
+            p.mix_gain, object() if key is None else key)
+
+
+def _frames(fingerprint: tuple) -> tuple[int, int]:
+    # one sample of margin, the playables are placed on the closest sample of their start
+    return fingerprint[0] - 1, fingerprint[1] + 1
+
+
+def _merge(windows: Iterable[tuple[int, int]], total: int) -> list[tuple[int, int]]:
+    """Sorted union of the `windows` of frames, within the `total` frames of the song"""
+    merged: list[list[int]] = []
+    for start, stop in sorted((max(a, 0), min(b, total)) for a, b in windows):
+        if start >= stop:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return [(a, b) for a, b in merged]
+
+
+def _render_slice(args: tuple[str, tuple[int, ...], int, int, list[Playable]]) -> tuple[int, np.ndarray]:
+    """
+    Mixes the playables starting in a slice, writing the frames of the slice into the shared buffer.
+    Returns the first frame after the slice and the mix from there.
+    """
+    name, shape, start, stop, playables = args
+    order = {id(p): i for i, p in enumerate(playables)}
+
+    # sounds are summed in the order of the playables, whatever the order they were rendered in
+    rendered = sorted(Song.render_playables(playables), key=lambda x: order[id(x[0])])
+    starts = [round(SAMPLE_RATE * p.start) for p, _ in rendered]
+    end = min(max(first + sound.shape[0] for first, (_, sound) in zip(starts, rendered)), shape[0])
+    channels = shape[1] if len(shape) > 1 else 1
+
+    mix = np.zeros((max(end - start, 0),) + shape[1:], dtype=np.float32)
+    for first, (p, sound) in zip(starts, rendered):
+        mix_into(mix, start, sound, first, p.channel_gains(channels))
 
-                note_split = n.split('*')
-                if len(note_split) == 1:
-                    tone_string = note_split[0]
-                    note_length = 1.0
-                else:
-                    tone_string = note_split[1]
-                    note_length = float(note_split[0])
-
-                notes.append(Note(
-                    tone=Tone.from_string(tone_string),
-                    timbre=timbre,
-                    start=t * 60 / bpm,
-                    length=note_length * 60 / bpm,
-                    effects=line[2]
-                ))
-                t += note_length
-
-        return cls(notes)
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        samples = np.ndarray(shape, dtype=np.float32, buffer=memory.buf)
+        own = min(stop - start, mix.shape[0])
+        samples[start:start + own] = mix[:own]
+        del samples
+    finally:
+        memory.close()
+    return stop, np.ascontiguousarray(mix[stop - start:])
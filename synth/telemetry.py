@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import csv
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import numpy as np
+
+from .constants import SAMPLE_RATE
+
+"""
+Module profiling renders: while a `Profiler` is enabled, every call to `Playable.generate`/`render`,
+`Song.generate_raw`, `Note.render_batch` (and each batch of voices it renders) and the methods of the effects is
+recorded as a `Span`.
+When no profiler is enabled, the hooks only check a global, so they can stay in the hot paths.
+Playables rendered by the worker processes of a parallel `Song` are not recorded.
+"""
+
+
+@dataclass
+class Span:
+    stage: str
+    name: str
+    # identifies the object the stage ran on, e.g. "Note#7f3a2c" or "Noise#7f3a90"
+    identity: str
+    # seconds since the profiler was enabled
+    begin: float
+    duration: float
+    samples: int
+    # size of the output
+    bytes: int
+    # peak of the memory allocated during the stage, only measured with `Profiler(trace_memory=True)`
+    peak_bytes: Optional[int]
+    depth: int
+    thread: int
+    details: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def real_time_factor(self) -> Optional[float]:
+        """Render time over duration of the audio rendered: below 1, the stage runs faster than real time"""
+        return self.duration * SAMPLE_RATE / self.samples if self.samples else None
+
+
+def _output_size(value: Any) -> tuple[int, int]:
+    """(samples, bytes) of what a stage returned"""
+    if isinstance(value, np.ndarray):
+        return value.shape[0], value.nbytes
+    if isinstance(value, (list, tuple)) and all(isinstance(v, np.ndarray) for v in value):
+        return sum(v.shape[0] for v in value), sum(v.nbytes for v in value)
+    return 0, 0
+
+
+class Profiler:
+    """
+    Records the spans of the renders run while it is enabled (with `enable` or as a context manager).
+    `callback` is called with every span as soon as it ends.
+    """
+
+    def __init__(self, callback: Optional[Callable[[Span], None]] = None, trace_memory: bool = False):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.spans: list[Span] = []
+
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+        self._started_tracemalloc = False
+
+    def _stack(self) -> list[list[float]]:
+        # [allocated memory at the start of the span, peak seen in it so far] for every open span of the thread
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def call(self, stage: str, obj: Any, fn: Callable, *args, details: Optional[dict[str, Any]] = None,
+             **kwargs) -> Any:
+        """Calls `fn(*args, **kwargs)`, recording it as the `stage` of `obj` with the extra `details` of the span"""
+        stack = self._stack()
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            stack.append([current, current])
+        else:
+            stack.append([0, 0])
+
+        begin = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            start_memory, peak = stack.pop()
+
+        peak_bytes = None
+        if self.trace_memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            peak_bytes = peak - start_memory
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+
+        samples, nbytes = _output_size(result)
+        cls = obj if isinstance(obj, type) else type(obj)
+        details = {**{k: getattr(obj, k) for k in ("start", "length") if isinstance(getattr(obj, k, None), float)},
+                   **(details or {})}
+        self.record(Span(stage, cls.__name__, f"{cls.__name__}#{id(obj):x}", begin - self._origin, end - begin,
+                         samples, nbytes, peak_bytes, len(stack), threading.get_ident(), details))
+        return result
+
+    def record(self, span: Span) -> None:
+        self.spans.append(span)
+        if self.callback is not None:
+            self.callback(span)
+
+    def summary(self) -> list[dict[str, Any]]:
+        """Total time, calls, samples and real-time factor of every (stage, name), the slowest first"""
+        groups: dict[tuple[str, str], dict[str, Any]] = {}
+        for s in self.spans:
+            g = groups.setdefault((s.stage, s.name), {"stage": s.stage, "name": s.name, "calls": 0, "seconds": 0.0,
+                                                      "samples": 0})
+            g["calls"] += 1
+            g["seconds"] += s.duration
+            g["samples"] += s.samples
+        for g in groups.values():
+            g["real_time_factor"] = g["seconds"] * SAMPLE_RATE / g["samples"] if g["samples"] else None
+        return sorted(groups.values(), key=lambda g: -g["seconds"])
+
+    def report(self) -> str:
+        lines = [f"{'stage':<16}{'name':<20}{'calls':>8}{'seconds':>12}{'audio s':>12}{'RTF':>10}"]
+        for g in self.summary():
+            rtf = "" if g["real_time_factor"] is None else f"{g['real_time_factor']:.4f}"
+            lines.append(f"{g['stage']:<16}{g['name']:<20}{g['calls']:>8}{g['seconds']:>12.4f}"
+                         f"{g['samples'] / SAMPLE_RATE:>12.2f}{rtf:>10}")
+        return "\n".join(lines)
+
+    def to_chrome_trace(self, path: Union[str, Path]) -> None:
+        """Writes the spans as a Chrome trace (chrome://tracing, Perfetto)"""
+        pid = os.getpid()
+        events = [{
+            "name": f"{s.name}.{s.stage}",
+            "cat": s.stage,
+            "ph": "X",
+            "ts": s.begin * 1e6,
+            "dur": s.duration * 1e6,
+            "pid": pid,
+            "tid": s.thread,
+            "args": {"identity": s.identity, "samples": s.samples, "bytes": s.bytes, "peak_bytes": s.peak_bytes,
+                     "real_time_factor": s.real_time_factor, **s.details},
+        } for s in self.spans]
+        Path(path).write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+
+    def to_csv(self, path: Union[str, Path]) -> None:
+        """Writes one row per span, the details (start, note count...) being a JSON object in the last column"""
+        columns = ["stage", "name", "identity", "begin", "duration", "samples", "bytes", "peak_bytes", "depth",
+                   "thread", "real_time_factor"]
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns + ["details"])
+            for s in self.spans:
+                writer.writerow([getattr(s, c) for c in columns] + [json.dumps(s.details)])
+
+    def __enter__(self) -> Profiler:
+        enable(self)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        disable()
+
+
+# profiler recording the renders, None when profiling is disabled
+profiler: Optional[Profiler] = None
+
+
+def enable(p: Optional[Profiler] = None) -> Profiler:
+    global profiler
+    disable()
+    profiler = Profiler() if p is None else p
+    if profiler.trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        profiler._started_tracemalloc = True
+    return profiler
+
+
+def disable() -> None:
+    global profiler
+    if profiler is not None and profiler._started_tracemalloc:
+        tracemalloc.stop()
+        profiler._started_tracemalloc = False
+    profiler = None
+
+
+def profiled(stage: str) -> Callable[[Callable], Callable]:
+    """Decorates a method so that its calls are recorded as `stage` of its object while a profiler is enabled"""
+    def decorate(method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if profiler is None:
+                return method(self, *args, **kwargs)
+            return profiler.call(stage, self, method, self, *args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import pathlib
+import struct
+from typing import Union
+
+import numpy as np
+
+from .constants import SAMPLE_RATE
+
+"""
+Module writing WAV files in bulk, from the raw bytes of the sample buffers instead of one frame at a time.
+Samples are either int16 (as returned by `Playable.generate`) or floats between -1.0 and 1.0,
+of shape (frames,) for mono or (frames, channels).
+"""
+
+# format tag and bytes per sample of every supported sample format
+FORMATS = {
+    "int16": (1, 2),
+    "int24": (1, 3),
+    "float32": (3, 4),
+}
+
+
+def _format(sample_format: str) -> tuple[int, int]:
+    try:
+        return FORMATS[sample_format]
+    except KeyError:
+        raise ValueError(f"unknown sample format '{sample_format}', expected one of {', '.join(FORMATS)}") from None
+
+
+def header(frames: int, channels: int = 1, sample_format: str = "int16", sample_rate: int = SAMPLE_RATE) -> bytes:
+    format_tag, width = _format(sample_format)
+    data_size = frames * channels * width
+
+    fmt = struct.pack('<HHIIHH', format_tag, channels, sample_rate, sample_rate * channels * width,
+                      channels * width, width * 8)
+    if format_tag == 1:
+        chunks = b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+    else:
+        # non-PCM formats need an (empty) extension size and a fact chunk
+        fmt += struct.pack('<H', 0)
+        chunks = b'fmt ' + struct.pack('<I', len(fmt)) + fmt + b'fact' + struct.pack('<II', 4, frames)
+    chunks += b'data' + struct.pack('<I', data_size)
+
+    return b'RIFF' + struct.pack('<I', 4 + len(chunks) + data_size + data_size % 2) + b'WAVE' + chunks
+
+
+def encode(samples: np.ndarray, sample_format: str = "int16") -> np.ndarray:
+    """Converts samples to the given format, as an array whose raw bytes are the content of the data chunk"""
+    _format(sample_format)
+    if np.issubdtype(samples.dtype, np.integer):
+        if samples.dtype != np.int16:
+            raise TypeError(f"integer samples must be int16, got {samples.dtype}")
+        if sample_format == "int16":
+            return np.ascontiguousarray(samples, dtype='<i2')
+        if sample_format == "float32":
+            return (samples / 32768).astype('<f4')
+        scaled = samples.astype('<i4') << 8
+    else:
+        if sample_format == "float32":
+            return np.ascontiguousarray(samples, dtype='<f4')
+        if sample_format == "int16":
+            return np.round(np.clip(samples, -1.0, 1.0) * 32767).astype('<i2')
+        scaled = np.round(np.clip(samples, -1.0, 1.0) * 8388607).astype('<i4')
+
+    # int24: keep the 3 low bytes of every little-endian int32
+    return scaled.view(np.uint8).reshape(scaled.shape + (4,))[..., :3].copy()
+
+
+def write(path: Union[str, pathlib.Path], samples: np.ndarray, sample_format: str = "int16",
+          sample_rate: int = SAMPLE_RATE) -> None:
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    data = encode(samples, sample_format)
+    with open(path, 'wb') as f:
+        f.write(header(samples.shape[0], channels, sample_format, sample_rate))
+        f.write(data.tobytes())
+        if data.nbytes % 2:
+            f.write(b'\0')
+
+
+class WavMemmap:
+    """
+    WAV file of a known length whose data chunk is memory-mapped, to be filled in place block by block.
+    For int16 and float32, `data` can also be written to directly.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path], frames: int, channels: int = 1,
+                 sample_format: str = "int16", sample_rate: int = SAMPLE_RATE):
+        _, width = _format(sample_format)
+        self.frames = frames
+        self.channels = channels
+        self.sample_format = sample_format
+
+        head = header(frames, channels, sample_format, sample_rate)
+        size = frames * channels * width
+        with open(path, 'wb') as f:
+            f.write(head)
+            f.truncate(len(head) + size + size % 2)
+
+        self.raw = np.memmap(path, dtype=np.uint8, mode='r+', offset=len(head), shape=(frames, channels * width))
+        if sample_format == "int24":
+            self.data = None
+        else:
+            self.data = self.raw.view('<i2' if sample_format == "int16" else '<f4')
+            if channels == 1:
+                self.data = self.data[:, 0]
+
+    def write(self, start: int, samples: np.ndarray) -> None:
+        if not samples.shape[0]:
+            return
+        self.raw[start:start + samples.shape[0]] = encode(samples, self.sample_format) \
+            .view(np.uint8).reshape(samples.shape[0], -1)
+
+    def close(self) -> None:
+        self.raw.flush()
+        # the file is unmapped once the last view on it is gone
+        self.raw = self.data = None
+
+    def __enter__(self) -> WavMemmap:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
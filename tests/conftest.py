@@ -0,0 +1,17 @@
+from typing import Optional
+
+from synth import ADSR, Harmonic, Timbre, oscillators
+from synth.oscillators import Oscillator
+
+
+def timbre(*harmonics: Oscillator, pitch: Optional[ADSR] = None) -> Timbre:
+    """
+    Timbre whose n-th harmonic (n times the frequency, of amplitude 1 / n) is played by the n-th of `harmonics`,
+    a single sine by default. The pitch envelope is flat unless `pitch` is given.
+    """
+    return Timbre(
+        amplitude_enveloppe=ADSR(attack=.02, decay=.05, sustain=0.7, release=.1),
+        pitch_enveloppe=ADSR(attack=0.0, decay=0.0, sustain=0.0, release=0.0, level=1) if pitch is None else pitch,
+        harmonics=[Harmonic(frequency=n, amplitude=1.0 / n, oscillator=oscillator)
+                   for n, oscillator in enumerate(harmonics or (oscillators.sine,), 1)]
+    )
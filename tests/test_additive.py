@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from conftest import timbre
+from synth import Note, Timbre, Tone, additive, oscillators
+from synth.constants import SAMPLE_RATE
+
+RATIOS = np.arange(1, 25)
+AMPLITUDES = 1 / RATIOS
+
+
+def direct(cycles: np.ndarray) -> np.ndarray:
+    return sum(a * np.sin(2 * np.pi * r * cycles) for r, a in zip(RATIOS, AMPLITUDES))
+
+
+@pytest.mark.parametrize("frequency, tolerance", [(220.0, 1e-4), (np.linspace(200.0, 400.0, SAMPLE_RATE // 2), 2e-2)])
+def test_partials_match_the_sum_of_sines(frequency, tolerance):
+    t = np.arange(SAMPLE_RATE // 2) / SAMPLE_RATE
+    cycles, _ = oscillators.integrate_phase(t, frequency)
+    expected = direct(cycles)
+    error = additive.render_partials(cycles, RATIOS, AMPLITUDES) - expected
+    # the frequency evolves at frame rate, glides get a small phase error
+    assert np.sqrt(np.mean(error ** 2)) < tolerance * np.sqrt(np.mean(expected ** 2))
+
+
+def test_additive_timbre_matches_the_direct_path(monkeypatch):
+    note = Note(Tone(57), timbre(*[oscillators.sine] * len(RATIOS)), length=0.3)
+    sound = note.render_uncached()
+
+    monkeypatch.setattr(Timbre, "ADDITIVE_PARTIALS", len(RATIOS) + 1)
+    expected = note.render_uncached()
+    np.testing.assert_allclose(sound, expected, atol=1e-3 * np.max(np.abs(expected)))
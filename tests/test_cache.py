@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from conftest import timbre
+from synth import Note, Song, Tone, cache
+
+
+
+@pytest.fixture
+def render_cache():
+    render_cache = cache.RenderCache()
+    cache.set_render_cache(render_cache)
+    yield render_cache
+    cache.set_render_cache(None)
+
+
+def test_render_cache_hit_and_miss(render_cache):
+    note = Note(Tone(57), timbre(), length=0.2)
+    first = note.render()
+    assert (render_cache.hits, render_cache.misses) == (0, 1)
+
+    # the start is not part of the render
+    note.start = 1.0
+    np.testing.assert_array_equal(note.render(), first)
+    assert (render_cache.hits, render_cache.misses) == (1, 1)
+
+    note.tone = Tone(60)
+    assert not np.array_equal(note.render(), first)
+    assert (render_cache.hits, render_cache.misses) == (1, 2)
+
+
+class Slotted:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def test_numpy_ufuncs_are_hashed_by_name():
+    assert cache.stable_hash(np.sin) == cache.stable_hash(np.sin)
+    assert cache.stable_hash(np.sin) != cache.stable_hash(np.cos)
+
+
+@pytest.mark.parametrize("value", [{1, 2}, np.frompyfunc(abs, 1, 1), Slotted(1)])
+def test_values_without_attributes_are_uncacheable(render_cache, value):
+    with pytest.raises(cache.Uncacheable):
+        cache.stable_hash(value)
+
+    note = Note(Tone(57), timbre(), length=0.2)
+    note.extra = value
+    assert note.cache_key() is None
+    Song([note]).generate()
+    assert render_cache.stats()["entries"] == 0
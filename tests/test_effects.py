@@ -0,0 +1,20 @@
+import numpy as np
+
+from synth.constants import SAMPLE_RATE
+from synth.effects import LowPassFilter
+from synth.effects.modulators import LFO
+
+
+def test_modulated_filter_gives_the_same_result_in_blocks():
+    size = 3 * SAMPLE_RATE // 2
+    t = np.arange(size) / SAMPLE_RATE
+    sound = np.random.default_rng(0).uniform(-4096, 4096, size).astype(np.float32)
+
+    def lowpass() -> LowPassFilter:
+        return LowPassFilter(LFO(frequency=3.0, amplitude=600, center=1200), resonance=0.5)
+
+    whole = lowpass().postprocess(t, sound.copy(), None)
+    streamed = lowpass()
+    blocks = np.concatenate([streamed.process_block(t[i:i + 1000], sound[i:i + 1000], None)
+                             for i in range(0, size, 1000)])
+    np.testing.assert_allclose(blocks, whole, atol=1e-4 * np.max(np.abs(whole)))
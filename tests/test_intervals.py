@@ -0,0 +1,49 @@
+import random
+from dataclasses import dataclass
+
+import pytest
+
+from synth.intervals import IntervalIndex
+
+
+@dataclass(eq=False)
+class Item:
+    start: float
+    end: float
+
+
+def brute_force(items, start, end):
+    return sorted((x for x in items if x.start < end and x.end > start), key=lambda x: x.start)
+
+
+def test_overlapping_after_add_and_remove():
+    generator = random.Random(0)
+    items = [Item(s, s + generator.uniform(0.0, 3.0)) for s in (generator.uniform(0.0, 20.0) for _ in range(50))]
+    index = IntervalIndex(items[:30])
+    for item in items[30:]:
+        index.add(item)
+    for item in items[::3]:
+        index.remove(item)
+    kept = [x for x in items if x not in items[::3]]
+
+    assert len(index) == len(kept)
+    assert index.end == max(x.end for x in kept)
+    for _ in range(100):
+        start = generator.uniform(-1.0, 25.0)
+        end = start + generator.uniform(0.0, 4.0)
+        assert [id(x) for x in index.overlapping(start, end)] == [id(x) for x in brute_force(kept, start, end)]
+
+
+def test_overlapping_bounds_are_exclusive():
+    a, b = Item(0.0, 1.0), Item(1.0, 2.0)
+    index = IntervalIndex([b, a])
+    assert index.items == [a, b]
+    assert index.overlapping(1.0, 1.5) == [b]
+    assert index.overlapping(0.5, 1.0) == [a]
+    assert index.overlapping(2.0, 3.0) == []
+
+
+def test_remove_missing_item():
+    index = IntervalIndex([Item(0.0, 1.0)])
+    with pytest.raises(ValueError):
+        index.remove(Item(0.0, 1.0))
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from conftest import timbre
+from synth import ADSR, Note, Tone, oscillators
+from synth.constants import SAMPLE_RATE
+from synth.effects import LowPassFilter
+
+
+
+def test_batched_voices_match_single_voices(monkeypatch):
+    # every voice in a single batch
+    monkeypatch.setattr(Note, "BATCH_SAMPLES", 1 << 20)
+    shared = timbre(oscillators.sine, oscillators.triangle,
+                    pitch=ADSR(attack=.05, decay=.05, sustain=0.5, release=.1, level=0.5))
+    notes = [Note(Tone(45 + 5 * i), shared, length=0.05 + 0.07 * i, volume=0.5 + 0.1 * i) for i in range(6)]
+    notes[2].effects = [LowPassFilter(1500, mode="iir")]
+
+    batched = Note.render_batch(notes)
+    for note, sound in zip(notes, batched):
+        single = Note.render_batch([note])[0]
+        assert sound.shape == single.shape
+        np.testing.assert_allclose(sound, single, rtol=1e-5, atol=1e-3)
+
+
+def old_envelope(envelope: ADSR, t: np.ndarray, duration: float) -> np.ndarray:
+    """The envelope as it was computed before `ADSR.segments`: a product of ramps over the whole note"""
+    attack = np.minimum(envelope.attack, duration)
+    decay = np.clip(duration - envelope.attack, 0.0, envelope.decay)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        decay_signal = (1.0 - envelope.sustain) * ADSR.ramp(t, decay, start=attack, inverse=True) + envelope.sustain
+    release_signal = ADSR.ramp(t, envelope.release, start=duration, inverse=True)
+    return ADSR.ramp(t, attack) * decay_signal * release_signal * envelope.level
+
+
+@pytest.mark.parametrize("envelope, duration", [
+    (ADSR(attack=0.0, decay=0.0, sustain=0.0, release=0.0), 0.1),
+    (ADSR(attack=0.0, decay=0.0, sustain=0.5, release=0.0), 0.1),
+    (ADSR(attack=.05, decay=.1, sustain=0.6, release=.1), 0.3),
+    (ADSR(attack=.05, decay=.1, sustain=0.6, release=.1), 0.02),
+    (ADSR(attack=.05, decay=.1, sustain=0.6, release=.1), 0.1),
+    (ADSR(attack=.05, decay=.1, sustain=0.6, release=.1, level=0.5), 0.3),
+    (ADSR(attack=.05, decay=.1, sustain=0.6, release=.1, level=-2.0), 0.1),
+])
+def test_envelope_matches_the_old_formula(envelope, duration):
+    size = round((duration + envelope.release) * SAMPLE_RATE)
+    step = (duration + envelope.release) / (size - 1)
+    t = np.arange(size) * step
+
+    expected = old_envelope(envelope, t, duration)
+    if duration < envelope.attack:
+        # notes ending in their attack used to dip to the sustain level until their release
+        expected[t < duration] /= envelope.sustain
+    np.testing.assert_allclose(envelope.get(t, duration), expected, atol=1e-12)
+    np.testing.assert_allclose(envelope.render(size, step, duration), expected, atol=1e-12)
+    # any block of the note
+    np.testing.assert_allclose(envelope.get(t[size // 3:size // 2], duration), expected[size // 3:size // 2],
+                               atol=1e-12)
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from conftest import timbre
+from synth import oscillators
+from synth.constants import SAMPLE_RATE
+from synth.effects.modulators import LFO
+
+
+def old_sine(t, f):
+    return np.sin(2 * np.pi * t * f)
+
+
+
+def test_oscillators_without_phase_still_work():
+    assert oscillators.accepts_phase(oscillators.sine)
+    assert oscillators.accepts_phase(oscillators.Pulse(0.3))
+    assert not oscillators.accepts_phase(old_sine)
+
+    t = np.linspace(0, 0.2, round(0.2 * SAMPLE_RATE))[None, :]
+    frequency = np.array([[440.0]])
+    # the old convention ignores the small pitch changes of the envelope
+    np.testing.assert_allclose(timbre(old_sine).render(t, frequency, 0.1),
+                               timbre(oscillators.sine).render(t, frequency, 0.1), atol=1e-3)
+
+    t = np.arange(1000) / SAMPLE_RATE
+    np.testing.assert_allclose(LFO(3.0, 1.0, oscillator=old_sine).get_value(t),
+                               LFO(3.0, 1.0).get_value(t), atol=1e-6)
+    np.testing.assert_allclose(oscillators.Wavetable(old_sine).tables,
+                               oscillators.Wavetable(oscillators.sine).tables, atol=1e-9)
+
+
+@pytest.mark.parametrize("interpolation", ["linear", "cubic"])
+@pytest.mark.parametrize("frequency", [30.0, 440.0])
+def test_wavetable_matches_the_naive_oscillator(interpolation, frequency):
+    t = np.arange(4410) / SAMPLE_RATE
+    np.testing.assert_allclose(oscillators.Wavetable(oscillators.sine, interpolation)(t, frequency),
+                               oscillators.sine(t, frequency), atol=1e-5)
+    np.testing.assert_allclose(oscillators.Wavetable(oscillators.triangle, interpolation)(t, frequency),
+                               oscillators.triangle(t, frequency), atol=1e-2)
+
+    # only the harmonics above the Nyquist frequency are dropped, the spectrum below 2 kHz is the same
+    band_limited = np.fft.rfft(oscillators.Wavetable(oscillators.sawtooth, interpolation)(t, frequency))[:200]
+    naive = np.fft.rfft(oscillators.sawtooth(t, frequency))[:200]
+    np.testing.assert_allclose(band_limited / t.shape[0], naive / t.shape[0], atol=5e-3)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from synth import pitch
+from synth.constants import SAMPLE_RATE
+
+
+def sine(frequency: float, seconds: float = 1.0) -> np.ndarray:
+    return np.sin(2 * np.pi * frequency * np.arange(round(seconds * SAMPLE_RATE)) / SAMPLE_RATE).astype(np.float32)
+
+
+def peak(sound: np.ndarray) -> float:
+    """Frequency of the highest peak of the spectrum of `sound`"""
+    return np.argmax(np.abs(np.fft.rfft(sound))) * SAMPLE_RATE / sound.shape[0]
+
+
+@pytest.mark.parametrize("interval", [-12, -5, 7, 12])
+def test_resample_shift_moves_the_pitch_and_keeps_the_length(interval):
+    sound = sine(440.0)
+    shifted = pitch.resample_shift(sound, interval)
+    assert shifted.shape == sound.shape
+    # only the part read from the sound, the rest of a shift up is silence
+    played = shifted[:round(sound.shape[0] / max(2 ** (interval / 12), 1.0))]
+    assert peak(played) == pytest.approx(440.0 * 2 ** (interval / 12), abs=2.0)
+
+
+def test_varispeed_shift_with_a_constant_interval_is_resample_shift():
+    sound = sine(440.0, 0.2)
+    np.testing.assert_allclose(pitch.varispeed_shift(sound, np.full(sound.shape[0], 5.0)),
+                               pitch.resample_shift(sound, 5), atol=1e-5)
+
+
+def test_cache_hit_returns_the_same_array():
+    shifter = pitch.PitchShifter("resample")
+    sound = sine(440.0, 0.1)
+    first = shifter.shift(sound, 3)
+    assert shifter.shift(sound, 3) is first
+    assert not first.flags.writeable
+    assert shifter.cache.stats()["hits"] == 1
+    assert shifter.shift(sound, 0) is sound
+    assert shifter.shift(sound, 4) is not first
+
+
+def test_disk_cache_round_trip(tmp_path):
+    sound = sine(440.0, 0.1)
+    first = pitch.PitchShifter("resample", directory=tmp_path).shift_many(sound, [-2, 5])
+    assert len(list(tmp_path.glob("*.npy"))) == 2
+
+    # a new shifter, as in another process, reads them back from the disk
+    shifter = pitch.PitchShifter("resample", directory=tmp_path)
+    again = shifter.shift_many(sound, [-2, 5])
+    assert shifter.cache.stats()["disk_hits"] == 2
+    for interval in (-2, 5):
+        np.testing.assert_array_equal(again[interval], first[interval])
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError, match="unknown method 'granular'"):
+        pitch.PitchShifter("granular")
+    with pytest.raises(ValueError, match="unknown method"):
+        pitch.PitchShifter("resample").shift(sine(440.0, 0.1), 2, "granular")
@@ -0,0 +1,40 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from synth import Playable, Sample
+from synth.effects import LowPassFilter, Noise
+
+
+class Stored(Playable):
+    """Playable whose `generate_raw` returns the same array every time"""
+
+    def __init__(self, effects):
+        self.start = 0.0
+        self.length = 0.1
+        self.volume = 0.5
+        self.effects = effects
+        self.data = np.linspace(-1.0, 1.0, 4410, dtype=np.float32)
+
+    def generate_raw(self, t: np.ndarray) -> np.ndarray:
+        return self.data
+
+
+@pytest.mark.parametrize("effects", [[], [Noise(1e-3, seed=0), LowPassFilter(2000, mode="iir")]])
+def test_render_does_not_modify_the_output_of_generate_raw(effects):
+    p = Stored(effects)
+    data = p.data.copy()
+    first = p.render_uncached()
+    np.testing.assert_array_equal(p.data, data)
+    np.testing.assert_array_equal(p.render_uncached(), first)
+
+
+def test_sample_data_replaced_after_loading_is_hashed():
+    sample = Sample(Path(__file__).parent.parent / "samples" / "middle_c.wav")
+    key = sample.cache_key()
+    assert sample.transposed(0).cache_key() == key
+
+    sample.data = sample.data[::-1]
+    assert sample.source is None
+    assert sample.cache_key() != key
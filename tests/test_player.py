@@ -0,0 +1,38 @@
+import asyncio
+import itertools
+import time
+
+import numpy as np
+
+from synth.player import BackgroundRenderer, iterate_async
+
+
+def slow_blocks():
+    for _ in itertools.count():
+        time.sleep(0.02)
+        yield np.zeros(100, dtype=np.float32)
+
+
+def test_cancelling_the_consumer_of_iterate_async():
+    async def consume():
+        async for _ in iterate_async(slow_blocks(), depth=2):
+            pass
+
+    async def main():
+        try:
+            await asyncio.wait_for(consume(), 0.2)
+        except asyncio.TimeoutError:
+            return True
+        return False
+
+    begin = time.perf_counter()
+    assert asyncio.run(main())
+    assert time.perf_counter() - begin < 2.0
+
+
+def test_get_returns_none_after_close():
+    renderer = BackgroundRenderer(slow_blocks(), depth=2)
+    assert renderer.get(timeout=1.0) is not None
+    renderer.close()
+    assert renderer.get(timeout=1.0) is None
+    assert renderer.get(timeout=1.0) is None
@@ -0,0 +1,26 @@
+from pathlib import Path
+
+import numpy as np
+
+from synth import Sample, rng
+from synth.effects import Noise, Scratch
+
+
+def test_noise_of_mono_sound_with_a_channel_axis():
+    mono = np.zeros(1000, dtype=np.float32)
+    column = np.zeros((1000, 1), dtype=np.float32)
+
+    rng.add_uniform(mono, 1, 7, 2.0)
+    rng.add_uniform(column, 1, 7, np.full((1000, 1), 2.0))
+    np.testing.assert_array_equal(column[:, 0], mono)
+
+    rng.scatter(mono, 1, 7, 0.3, 2.0)
+    rng.scatter(column, 1, 7, 0.3, 2.0)
+    np.testing.assert_array_equal(column[:, 0], mono)
+
+
+def test_effects_on_sample_with_one_channel():
+    sample = Sample(Path(__file__).parent.parent / "samples" / "middle_c.wav", mono=False)
+    sample.effects = [Noise(1e-3, seed=0), Scratch(0.01, seed=0)]
+    sound = sample.render()
+    assert sound.shape == sample.data.shape
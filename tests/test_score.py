@@ -0,0 +1,29 @@
+import numpy as np
+
+from conftest import timbre
+from synth import Score, Song, oscillators
+from synth.effects import LowPassFilter
+
+
+
+LINES = [
+    (timbre(oscillators.sine), "C4 E4 - 2*G4 C4 E4 -- G4", []),
+    (timbre(oscillators.triangle), "C3 -- C3 2*F3 G3", [LowPassFilter(1200, mode="iir")]),
+]
+
+
+def test_score_parses_like_from_lines():
+    score = Score.parse(240, LINES)
+    song = Song.from_lines(240, LINES)
+    assert len(score) == len(song.playables) == 10
+    assert sorted((n.start, n.raw_length, n.tone.id) for n in score.notes()) == \
+        sorted((n.start, n.raw_length, n.tone.id) for n in song.playables)
+
+
+def test_score_renders_like_from_lines():
+    score = Score.parse(240, LINES)
+    song = Song.from_lines(240, LINES)
+    expected = song.render()
+    sound = score.render()
+    assert sound.shape == expected.shape
+    np.testing.assert_allclose(sound, expected, atol=1e-2)
@@ -0,0 +1,100 @@
+import json
+import wave
+
+import pytest
+
+from synth import oscillators, service
+from synth.constants import SAMPLE_RATE
+
+TIMBRE = {"amplitude": {"attack": 0.01, "decay": 0.01, "sustain": 0.5, "release": 0.01}}
+
+
+def job(**kwargs) -> dict:
+    return dict({"lines": [{"timbre": TIMBRE, "notes": "C4 E4"}]}, **kwargs)
+
+
+def with_oscillator(oscillator) -> dict:
+    return job(lines=[{"timbre": dict(TIMBRE, harmonics=[{"frequency": 1, "amplitude": 1.0,
+                                                          "oscillator": oscillator}]), "notes": "C4"}])
+
+
+@pytest.mark.parametrize("spec, expected", [
+    ("triangle", oscillators.triangle),
+    ({"type": "Pulse", "width": 0.25}, oscillators.Pulse(0.25)),
+    ({"type": "Wavetable", "oscillator": {"type": "Pulse", "width": 0.5}, "interpolation": "cubic"}, None),
+])
+def test_build_oscillators(spec, expected):
+    oscillator = service.build(with_oscillator(spec)).playables[0].timbre.harmonics[0].oscillator
+    if expected is None:
+        assert isinstance(oscillator, oscillators.Wavetable) and oscillator.oscillator == oscillators.Pulse(0.5)
+    else:
+        assert oscillator == expected
+
+
+@pytest.mark.parametrize("spec", ["integrate_phase", "oscillate", "Pulse", {"type": "Pulse"},
+                                  {"type": "Wavetable", "interpolation": "quadratic"}, {"type": "PhaseAccumulator"}])
+def test_build_rejects_unknown_oscillators(spec):
+    with pytest.raises(service.JobError):
+        service.build(with_oscillator(spec))
+
+
+def test_build_song():
+    song = service.build(job(effects=[{"type": "LowPassFilter", "cutout": 880,
+                                       "resonance": {"type": "LFO", "frequency": 2, "amplitude": 0.2}}]))
+    assert len(song.playables) == 2
+    assert song.effects[0].resonance.frequency == 2
+
+
+@pytest.mark.parametrize("spec", [
+    job(effects=[{"type": "Reverb"}]),
+    job(effects=[{"type": "LowPassFilter", "cutout": {"type": "Effect"}}]),
+    {"lines": [{"timbre": {}, "notes": "C4"}]},
+    {},
+])
+def test_build_rejects_invalid_jobs(spec):
+    with pytest.raises(service.JobError):
+        service.build(spec)
+
+
+@pytest.mark.parametrize("spec, error", [
+    (job(), "JobError: the job has no output"),
+    ({"output": "x.wav"}, "JobError: the job has neither lines nor samples"),
+])
+def test_render_reports_errors(spec, error):
+    report = service.render(dict(spec, id="a"))
+    assert report["id"] == "a" and report["status"] == "error"
+    assert report["error"] == error
+
+
+class Recorder:
+    """Stands for a `RenderService`, recording the jobs submitted to it"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, job, on_result):
+        self.jobs.append(job)
+
+
+def test_serve_lines_reports_invalid_lines():
+    reports = []
+    recorder = Recorder()
+    service.serve_lines(recorder, ["\n", "[1, 2]\n", "{\"id\": \n", json.dumps(job(id="ok")) + "\n"], reports.append)
+
+    assert [j["id"] for j in recorder.jobs] == ["ok"]
+    assert [r["status"] for r in reports] == ["error", "error"]
+    assert reports[0]["error"] == "JobError: a job must be a JSON object"
+    assert reports[1]["error"].startswith("JSONDecodeError")
+
+
+def test_render_service_writes_a_wav(tmp_path):
+    reports = []
+    with service.RenderService(workers=1, warm=False) as s:
+        future = s.submit(job(id="a", output=str(tmp_path / "a.wav")), reports.append)
+    report = future.result()
+
+    assert reports == [report]
+    assert report["status"] == "ok", report.get("error")
+    with wave.open(str(tmp_path / "a.wav")) as f:
+        assert f.getframerate() == SAMPLE_RATE
+        assert f.getnframes() == report["frames"]
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from conftest import timbre
+from synth import Note, Song, Tone, oscillators, wavfile
+from synth.constants import SAMPLE_RATE
+
+
+
+def read(path, frames: int, channels: int, sample_format: str) -> np.ndarray:
+    offset = len(wavfile.header(frames, channels, sample_format))
+    data = np.fromfile(path, dtype='<f4' if sample_format == "float32" else '<i2', offset=offset)
+    return data if channels == 1 else data.reshape(-1, channels)
+
+
+@pytest.mark.parametrize("channels", [1, 2])
+def test_save_stream_matches_generate_and_save(tmp_path, channels):
+    # a single note is already normalized, so the streamed song is the same as the song rendered as a whole
+    note = Note(Tone(57), timbre(oscillators.sine, oscillators.sawtooth), length=0.3)
+    note.pan = -0.5
+    song = Song([note], channels=channels)
+    frames = round(song.length * SAMPLE_RATE)
+
+    song.generate_and_save(tmp_path / "whole.wav", "float32")
+    song.save_stream(tmp_path / "stream.wav", block_size=1000, sample_format="float32")
+
+    whole = read(tmp_path / "whole.wav", frames, channels, "float32")
+    stream = read(tmp_path / "stream.wav", frames, channels, "float32")
+    assert whole.shape == stream.shape
+    assert np.flatnonzero(stream.reshape(frames, -1).any(axis=1))[0] == \
+        np.flatnonzero(whole.reshape(frames, -1).any(axis=1))[0]
+    np.testing.assert_allclose(stream, whole, atol=1e-6)
+
+
+def test_incremental_mix_sees_changes_made_in_place():
+    from synth.effects import LowPassFilter
+
+    notes = [Note(Tone(57 + i), timbre(oscillators.sine, oscillators.sawtooth), start=i * 0.2, length=0.3)
+             for i in range(4)]
+    notes[1].effects = [LowPassFilter(2000, mode="iir")]
+    song = Song(notes, incremental=True)
+    song.render()
+
+    notes[1].effects[0].cutout = 200
+    notes[2].timbre = timbre(oscillators.sine, oscillators.sawtooth)
+    notes[2].timbre.amplitude_enveloppe.sustain = 0.2
+    notes[3].tone = Tone(40)
+
+    song.incremental = False
+    expected = song.render()
+    song.incremental = True
+    np.testing.assert_array_equal(song.render(), expected)
+
+
+def test_parallel_mix_does_not_depend_on_the_number_of_workers():
+    shared = timbre(oscillators.sine, oscillators.sawtooth)
+    notes = [Note(Tone(50 + i % 12), shared, start=i * 0.23, length=0.4) for i in range(24)]
+    mixes = [Song(notes, workers=workers).render() for workers in (2, 3)]
+    np.testing.assert_array_equal(mixes[0], mixes[1])
+    np.testing.assert_allclose(Song(notes).render(), mixes[0], atol=1e-3)
+
+
+def test_incremental_mix_after_a_parallel_mix():
+    notes = [Note(Tone(50 + i % 12), timbre(), start=i * 0.23, length=0.4) for i in range(24)]
+    song = Song(notes, workers=2, incremental=True)
+    song.render()
+
+    notes[5].tone = Tone(70)
+    notes[20].start = 0.1
+    np.testing.assert_allclose(song.render(), Song(notes).render(), atol=1e-3)
+
+
+def test_notes_moved_in_place_are_found_by_the_song():
+    notes = [Note(Tone(57 + i), timbre(), start=i * 0.2, length=0.3) for i in range(4)]
+    song = Song(notes)
+    song.render()
+
+    notes[0].start = 2.0
+    assert song.between(1.9, 2.1) == [notes[0]]
+    assert song.playables[-1] is notes[0]
+    song.remove(notes[0])
+    assert notes[0] not in song.playables
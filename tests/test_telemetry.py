@@ -0,0 +1,44 @@
+import csv
+import json
+
+from conftest import timbre
+from synth import Note, Song, Tone, telemetry
+from synth.effects import LowPassFilter
+
+
+def profiled_song() -> tuple[telemetry.Profiler, list[Note]]:
+    shared = timbre()
+    notes = [Note(Tone(57 + i), shared, start=i * 0.1, length=0.1) for i in range(5)]
+    notes[0].effects = [LowPassFilter(2000, mode="iir")]
+    with telemetry.Profiler() as profiler:
+        Song(notes).generate()
+    return profiler, notes
+
+
+def test_chrome_trace(tmp_path):
+    profiler, notes = profiled_song()
+    profiler.to_chrome_trace(tmp_path / "trace.json")
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+
+    assert len(events) == len(profiler.spans)
+    assert {e["name"] for e in events} >= {"Song.generate", "Song.generate_raw", "Note.render_batch", "Note.voices",
+                                           "LowPassFilter.postprocess"}
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
+    # every note shows up in the batches of voices, with its tone
+    voices = [e["args"] for e in events if e["name"] == "Note.voices"]
+    assert sum(v["notes"] for v in voices) == len(notes)
+    assert sorted(t for v in voices for t in v["tones"]) == [n.tone.id for n in notes]
+
+
+def test_csv(tmp_path):
+    profiler, notes = profiled_song()
+    profiler.to_csv(tmp_path / "spans.csv")
+    with open(tmp_path / "spans.csv", newline="") as f:
+        rows = list(csv.DictReader(f))
+
+    assert len(rows) == len(profiler.spans)
+    assert [r["stage"] for r in rows] == [s.stage for s in profiler.spans]
+    generate = next(r for r in rows if r["stage"] == "generate")
+    assert float(generate["duration"]) > 0 and int(generate["samples"]) > 0
+    voices = [json.loads(r["details"]) for r in rows if r["stage"] == "voices"]
+    assert sum(v["notes"] for v in voices) == len(notes)